@@ -18,9 +18,9 @@ BuildArch: noarch
 BuildRequires: rpm-build-intro
 
 BuildRequires: python-module-setuptools
-BuildRequires: git-core >= 1.7
+BuildRequires: git-core >= 2.17
 
-Requires: git-core >= 1.7
+Requires: git-core >= 2.17
 
 %py_use GitPython >= 0.3.0
 
@@ -17,6 +17,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-from gitupstream import GitUpstream
+from gitupstream import GitUpstream, quick_status
 from errors import *
 from constants import *
+from batch import load_manifest, run_batch, CLEAN, CONFLICTED, FAILED, SKIPPED
+from daemon import Daemon, daemon_request, daemon_status, DAEMON_REQUESTS
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os
+from gitupstream import GitUpstream
+from errors import *
+from constants import *
+
+BATCH_OPERATIONS = ['merge', 'pull', 'status', 'push']
+
+CLEAN = 'clean'
+CONFLICTED = 'conflicted'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+def load_manifest(filename):
+	# every line is "<repo path> <operation> [<remote or branch>]"
+	jobs = []
+	with open(filename) as f:
+		num = 0
+		for i in f:
+			num += 1
+			parts = i.split('#')[0].split()
+			if not parts:
+				continue
+			if len(parts) > 3 or len(parts) < 2 or parts[1] not in BATCH_OPERATIONS:
+				raise ValueError('error in manifest file on line %d : %s' % (num, i.strip()))
+			jobs.append((parts[0], parts[1], parts[2] if len(parts) == 3 else None))
+	return jobs
+
+def _job_status(repo, job):
+	# the status of the repo is the outcome, a clean repo with upstream
+	# commits to merge from the given or tracked branch is not clean
+	path, operation, arg = job
+	status, summaries, diff = repo.get_status()
+	if status == STATUS_NEW_COMMITS:
+		return (path, operation, status, 'commits to save: %d' % len(summaries))
+	if status != STATUS_CLEAN:
+		return (path, operation, status, '')
+	try:
+		mbranch, commits = repo.merge_preview(arg)
+	except NoMergeBranch:
+		return (path, operation, status, '')
+	if commits:
+		return (path, operation, STATUS_UPSTREAM_COMMITS,
+			'commits to merge from %s: %d' % (mbranch, len(commits)))
+	return (path, operation, status, '')
+
+def run_job(job, repo=None):
+	# repo is a GitUpstream object of the job repo to reuse
+	path, operation, arg = job
+	try:
+		if not repo:
+			repo = GitUpstream(path)
+		if operation == 'merge':
+			repo.merge(arg)
+		elif operation == 'pull':
+			repo.pull(arg)
+		elif operation == 'push':
+			repo.push(arg)
+		elif operation == 'status':
+			return _job_status(repo, job)
+	except (RebaseFailed, PatchFailed):
+		# the state is saved: continue as usual with gitum merge/pull
+		return (path, operation, CONFLICTED, '')
+	except Exception as e:
+		return (path, operation, FAILED, '%s: %s' % (e.__class__.__name__, e))
+	return (path, operation, CLEAN, '')
+
+def _run_repo_jobs(jobs):
+	# jobs of one repo one after another; the rest of them are skipped
+	# once one conflicts or fails
+	res = []
+	stop = None
+	for job in jobs:
+		if stop:
+			res.append((job[0], job[1], SKIPPED, 'after %s %s' % (stop[1], stop[2])))
+			continue
+		res.append(run_job(job))
+		if res[-1][2] in [CONFLICTED, FAILED]:
+			stop = res[-1]
+	return res
+
+def run_batch(jobs, processes=None):
+	# jobs are (repo path, operation, remote or branch) tuples, the result
+	# is a (repo path, operation, outcome, message) tuple for each of them.
+	# Repos are processed in parallel, the jobs of a repo in manifest order.
+	repos = []
+	order = {}
+	for num, job in enumerate(jobs):
+		path = os.path.abspath(job[0])
+		if path not in order:
+			order[path] = len(repos)
+			repos.append([])
+		repos[order[path]].append((num, job))
+	groups = [[job for num, job in i] for i in repos]
+	if processes == 1:
+		results = map(_run_repo_jobs, groups)
+	else:
+		from multiprocessing import Pool
+		pool = Pool(processes)
+		try:
+			results = pool.map(_run_repo_jobs, groups, 1)
+		finally:
+			pool.close()
+			pool.join()
+	res = [None] * len(jobs)
+	for repo, outcomes in zip(repos, results):
+		for (num, job), outcome in zip(repo, outcomes):
+			res[num] = outcome
+	return res
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+from binascii import hexlify, unhexlify
+
+SHA_SIZE = 20
+
+# Commit SHAs kept as one array of 20 byte binary SHAs instead of a list of
+# hex strings: merging a whole release from an old base means tens of
+# thousands of them. Items are read and appended as hex strings.
+class CommitList(object):
+	def __init__(self, shas=(), data=''):
+		self._data = bytearray(data)
+		for i in shas:
+			self.append(i)
+
+	@classmethod
+	def from_lines(cls, lines):
+		# lines of hex SHAs, e.g. the output of git rev-list as it is read
+		res = cls()
+		for i in lines:
+			i = i.strip()
+			if i:
+				res.append(i)
+		return res
+
+	def append(self, sha):
+		self._data.extend(unhexlify(sha))
+
+	def data(self):
+		return str(self._data)
+
+	def __len__(self):
+		return len(self._data) // SHA_SIZE
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in xrange(*index.indices(len(self)))]
+		if index < 0:
+			index += len(self)
+		if index < 0 or index >= len(self):
+			raise IndexError(index)
+		return hexlify(self._data[index * SHA_SIZE:(index + 1) * SHA_SIZE])
+
+	def __iter__(self):
+		for i in xrange(len(self)):
+			yield self[i]
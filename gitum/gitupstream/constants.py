@@ -23,3 +23,11 @@ UPSTREAM_BRANCH = 'upstream'
 REBASED_BRANCH = 'rebased'
 MAINLINE_BRANCH = 'mainline'
 PATCHES_BRANCH = 'patches'
+
+# results of GitUpstream.status()
+STATUS_CLEAN = 'clean'
+STATUS_NEW_COMMITS = 'new-commits'
+STATUS_MODIFIED = 'modified'
+STATUS_LOCAL_CHANGES = 'local-changes'
+# reported by batch status for a clean repo with upstream commits to merge
+STATUS_UPSTREAM_COMMITS = 'upstream-commits'
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import socket
+import threading
+from Queue import Queue
+from subprocess import call
+from gitupstream import GitUpstream, status_messages
+from batch import run_job
+from errors import *
+from constants import *
+
+# Keeps a GitUpstream object of a repo resident and serves requests sent as
+# one JSON line ({"request": name, "arg": branch or remote}) over a Unix
+# socket, answering with one JSON line:
+#
+#   status          {"status", "messages", "diff"}
+#   preview [b]     {"branch", "commits": [{"commit", "summary", "conflicts"}]}
+#   merge [b]       {"job", "queued"} - jobs are run one by one
+#   pull [r]        {"job", "queued"}
+#   jobs            {"jobs": [{"job", "operation", "arg", "state", "message"}]}
+#   stop            {"stopped"}
+#
+# Failed requests are answered with {"error"}, status and preview requests
+# that come while a job is running with {"busy": job}.
+
+DAEMON_SOCKET = '.git/.gitum-daemon.sock'
+DAEMON_REQUESTS = ['status', 'preview', 'merge', 'pull', 'jobs', 'stop']
+# a client that has not sent its request in time is dropped, a status
+# request that is not answered in time falls back to reading the repo
+DAEMON_CONN_TIMEOUT = 0.5
+DAEMON_STATUS_TIMEOUT = 0.5
+
+QUEUED = 'queued'
+RUNNING = 'running'
+
+def _socket_name(repo_path):
+	return os.path.abspath(repo_path) + '/' + DAEMON_SOCKET
+
+def _recv_line(sock):
+	data = ''
+	while not data.endswith('\n'):
+		chunk = sock.recv(4096)
+		if not chunk:
+			break
+		data += chunk
+	return data
+
+def _stat(path):
+	try:
+		st = os.stat(path)
+	except OSError:
+		return (path,)
+	return (path, st.st_mtime, st.st_size, st.st_ino)
+
+def _refs_signature(repo_path):
+	# changes whenever a branch, HEAD or the saved gitum state is moved
+	git_dir = repo_path + '/.git'
+	res = [_stat(git_dir + '/' + i) for i in
+	       ['HEAD', 'packed-refs', '.curent_rebased', '.curent_mainline', '.gitum-state']]
+	for root, dirs, files in os.walk(git_dir + '/refs'):
+		dirs.sort()
+		res.extend([_stat(root + '/' + i) for i in sorted(files)])
+	return res
+
+def daemon_request(repo_path, name, arg=None, timeout=5.0):
+	# reply of the daemon serving the repo, None if there is no one
+	if not os.path.exists(_socket_name(repo_path)):
+		return None
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.settimeout(timeout)
+	try:
+		sock.connect(_socket_name(repo_path))
+		sock.sendall(json.dumps({'request': name, 'arg': arg}) + '\n')
+		return json.loads(_recv_line(sock))
+	except (socket.error, ValueError):
+		return None
+	finally:
+		sock.close()
+
+def daemon_status(repo_path='.', with_log=False):
+	# gitum status answered by the daemon, None if it can not answer
+	reply = daemon_request(repo_path, 'status', timeout=DAEMON_STATUS_TIMEOUT)
+	if not reply or 'status' not in reply:
+		return None
+	if with_log:
+		for i in reply['messages']:
+			print(i.encode('utf-8'))
+		if reply['status'] == STATUS_MODIFIED:
+			sys.stdout.flush()
+			call(['git', 'diff', '--full-index'] + reply['diff'], cwd=repo_path)
+	return reply['status']
+
+class Daemon(object):
+	def __init__(self, repo_path='.', with_log=False, poll=1.0):
+		self._path = os.path.abspath(repo_path)
+		self._with_log = with_log
+		self._poll = poll
+		self._repo = GitUpstream(self._path)
+		# answers for the current signature of the refs
+		self._signature = None
+		self._status = None
+		self._previews = {}
+		# the repo object is used by one request or job at a time
+		self._lock = threading.Lock()
+		self._jobs_lock = threading.Lock()
+		self._jobs = []
+		self._queue = Queue()
+		self._current = None
+		self._running = False
+
+	def serve(self):
+		sock = self._bind()
+		self._running = True
+		worker = threading.Thread(target=self._work)
+		worker.daemon = True
+		worker.start()
+		self._log('Serving %s.' % self._path)
+		try:
+			while self._running:
+				if select.select([sock], [], [], self._poll)[0]:
+					self._accept(sock)
+				elif self._lock.acquire(False):
+					# get the answer ready for the next status request
+					try:
+						self._refresh()
+						if self._status is None:
+							self._status = self._get_status()
+					finally:
+						self._lock.release()
+		finally:
+			sock.close()
+			os.unlink(_socket_name(self._path))
+
+	def stop(self):
+		self._running = False
+
+	def _bind(self):
+		name = _socket_name(self._path)
+		if daemon_request(self._path, 'jobs') is not None:
+			self._log_error('gitum daemon is already running.')
+			raise DaemonRunning
+		if os.path.exists(name):
+			os.unlink(name)
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.bind(name)
+		sock.listen(16)
+		return sock
+
+	def _accept(self, sock):
+		try:
+			conn = sock.accept()[0]
+		except socket.error as e:
+			if e.errno == errno.EINTR:
+				return
+			raise
+		# a slow client must not hold up the others
+		thread = threading.Thread(target=self._serve_conn, args=(conn,))
+		thread.daemon = True
+		thread.start()
+
+	def _serve_conn(self, conn):
+		try:
+			conn.settimeout(DAEMON_CONN_TIMEOUT)
+			try:
+				request = json.loads(_recv_line(conn))
+				reply = self._reply(request['request'], request.get('arg'))
+			except (ValueError, KeyError, TypeError):
+				reply = {'error': 'bad request'}
+			conn.sendall(json.dumps(reply) + '\n')
+		except socket.error:
+			pass
+		finally:
+			conn.close()
+
+	def _reply(self, name, arg):
+		if arg:
+			arg = arg.encode('utf-8')
+		if name == 'status':
+			return self._locked(self._reply_status)
+		elif name == 'preview':
+			return self._locked(self._reply_preview, arg)
+		elif name in ['merge', 'pull']:
+			with self._jobs_lock:
+				job = {'job': len(self._jobs) + 1, 'operation': name, 'arg': arg,
+				       'state': QUEUED, 'message': ''}
+				self._jobs.append(job)
+				self._queue.put(job)
+			return {'job': job['job'], 'queued': self._queue.qsize()}
+		elif name == 'jobs':
+			with self._jobs_lock:
+				return {'jobs': [dict(i) for i in self._jobs]}
+		elif name == 'stop':
+			self.stop()
+			return {'stopped': True}
+		return {'error': 'unknown request %s' % name}
+
+	def _locked(self, func, *args):
+		# wait for the status being computed by another request, but not
+		# for a whole job
+		while not self._lock.acquire(False):
+			if self._current is not None:
+				return {'busy': self._current}
+			time.sleep(0.01)
+		try:
+			self._refresh()
+			return func(*args)
+		finally:
+			self._lock.release()
+
+	def _refresh(self):
+		# drop the answers as soon as anything has moved
+		signature = _refs_signature(self._path)
+		if signature != self._signature:
+			self._signature = signature
+			self._status = None
+			self._previews = {}
+
+	def _get_status(self):
+		try:
+			status, summaries, diff = self._repo.get_status()
+		except GitUmException as e:
+			return {'error': e.__class__.__name__}
+		except Exception as e:
+			# e.g. a branch or a gitum file removed under us
+			return {'error': '%s: %s' % (e.__class__.__name__, e)}
+		return {'status': status, 'messages': status_messages(status, summaries),
+			'diff': list(diff)}
+
+	def _reply_status(self):
+		if self._status is None:
+			self._status = self._get_status()
+		return self._status
+
+	def _reply_preview(self, branch):
+		if branch not in self._previews:
+			try:
+				mbranch, commits = self._repo.merge_preview(branch)
+				self._previews[branch] = {
+					'branch': mbranch,
+					'commits': [{'commit': sha, 'summary': summary, 'conflicts': files}
+						    for sha, summary, files in commits],
+				}
+			except Exception as e:
+				return {'error': '%s: %s' % (e.__class__.__name__, e)}
+		return self._previews[branch]
+
+	def _work(self):
+		while True:
+			job = self._queue.get()
+			with self._lock:
+				self._current = job['job']
+				job['state'] = RUNNING
+				self._log('Running %s job %d.' % (job['operation'], job['job']))
+				outcome, message = run_job((self._path, job['operation'], job['arg']),
+							   self._repo)[2:]
+				job['state'] = outcome
+				job['message'] = message
+				self._current = None
+				self._log('Job %d is %s.' % (job['job'], outcome))
+
+	def _log_error(self, mess):
+		if self._with_log and mess:
+			print('error: %s' % mess)
+
+	def _log(self, mess):
+		if self._with_log and mess:
+			print(mess)
+			sys.stdout.flush()
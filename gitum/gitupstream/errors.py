@@ -62,3 +62,6 @@ class NoMergeBranch(GitUmException):
 
 class BranchExists(GitUmException):
 	pass
+
+class DaemonRunning(GitUmException):
+	pass
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import time
+from git import Git
+
+def subcommand(command):
+	if isinstance(command, basestring):
+		command = command.split()
+	for i in command[1:]:
+		if not i.startswith('-'):
+			return i
+	return command[0]
+
+# Git object that calls hooks after every command it runs:
+# hooks get (command, elapsed time, output) and object_hooks get
+# (request name, elapsed time, object size) for the requests served by the
+# persistent cat-file processes.
+class HookedGit(Git):
+	def __init__(self, working_dir=None):
+		super(HookedGit, self).__init__(working_dir)
+		self.hooks = []
+		self.object_hooks = []
+
+	def execute(self, command, *args, **kwargs):
+		start = time.time()
+		res = None
+		try:
+			res = super(HookedGit, self).execute(command, *args, **kwargs)
+			return res
+		finally:
+			for i in self.hooks:
+				i(command, time.time() - start, res)
+
+	def get_object_header(self, ref):
+		start = time.time()
+		try:
+			return super(HookedGit, self).get_object_header(ref)
+		finally:
+			for i in self.object_hooks:
+				i('cat-file --batch-check', time.time() - start, 0)
+
+	def stream_object_data(self, ref):
+		start = time.time()
+		res = None
+		try:
+			res = super(HookedGit, self).stream_object_data(ref)
+			return res
+		finally:
+			for i in self.object_hooks:
+				i('cat-file --batch', time.time() - start, res[2] if res else 0)
+
+def hooked(repo):
+	# make the GitPython object of repo (and its object database) a
+	# HookedGit one
+	if not isinstance(repo.git, HookedGit):
+		repo.git = HookedGit(repo.working_dir)
+		repo.odb = type(repo.odb)(repo.odb.root_path(), repo.git)
+	return repo.git
@@ -18,14 +18,20 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-from git import *
-from subprocess import Popen, call
+from subprocess import Popen, PIPE, call
 import os
 import tempfile
 import sys
 import shutil
+import binascii
+import hashlib
+import struct
+import time
 from errors import *
 from constants import *
+from history import PatchesHistory
+from refs import read_ref
+from commitlist import CommitList, SHA_SIZE
 
 START_ST = 0
 MERGE_ST = 1
@@ -35,33 +41,169 @@ COMMIT_ST = 3
 CONFIG_FILE = '.gitum-config'
 CONFIG_BRANCH = 'gitum-config'
 STATE_FILE = '.git/.gitum-state'
+# binary state file: the header is followed by all the commits of the merge,
+# the one to continue with is at STATE_HEADER.size + id * SHA_SIZE
+STATE_MAGIC = 'GITUMST1'
+STATE_HEADER = struct.Struct('>8s20s20s20s20s20s5I')
 REMOTE_REPO = '.git/.gitum-remote'
 MERGE_BRANCH = '.git/.gitum-mbranch'
 CURRENT_REBASED = '.git/.curent_rebased'
 CURRENT_MAINLINE = '.git/.curent_mainline'
+PATCH_CACHE = '.git/.gitum-patch-cache'
+HISTORY_INDEX = '.git/.gitum-history'
+STATUS_CACHE = '.git/.gitum-status'
+CONFIG_CACHE = '.git/.gitum-config-cache'
+REBASED_CACHE = '.git/.gitum-rebased-cache'
+WORKTREE_DIR = 'gitum-worktree'
+# git worktree remove, the oldest of the worktree commands we use
+WORKTREE_GIT_VERSION = (2, 17)
+# git commands that may move branches
+REF_COMMANDS = ['am', 'branch', 'checkout', 'cherry-pick', 'commit', 'fetch', 'merge',
+		'pull', 'rebase', 'reset', 'stash', 'update-ref', 'worktree']
 UPSTREAM_COMMIT_FILE = '_upstream_commit_'
 LAST_PATCH_FILE = '_current_patch_'
-TMP_LAST_PATCH_FILE = '_current.patch'
+
+# GitPython takes most of the start up time, so it (and everything built on
+# it) is only imported by the first GitUpstream object
+Repo = GitCmdObjectDB = GitCommandError = Actor = None
+Profiler = subcommand = hooked = None
+
+def _import_git():
+	global Repo, GitCmdObjectDB, GitCommandError, Actor, Profiler, subcommand, hooked
+	if Repo:
+		return
+	from git import Repo, GitCmdObjectDB, GitCommandError, Actor
+	from profiler import Profiler
+	from gitcmd import subcommand, hooked
+
+def _read_line(filename):
+	with open(filename) as f:
+		return f.readline().strip()
+
+def _config_key(repo_path):
+	# sha of the config branch, '-' if there is no one
+	return read_ref(repo_path + '/.git', CONFIG_BRANCH) or '-'
+
+def _load_config_cache(repo_path, key):
+	# (upstream, rebased, current, patches) branch names saved for the key
+	try:
+		with open(repo_path + '/' + CONFIG_CACHE) as f:
+			lines = f.read().split('\n')
+	except IOError:
+		return None
+	if len(lines) < 2 or lines[0] != key or len(lines[1].split(' ')) != 4:
+		return None
+	return tuple(lines[1].split(' '))
+
+def _save_config_cache(repo_path, key, config):
+	with open(repo_path + '/' + CONFIG_CACHE, 'w') as f:
+		f.write('%s\n%s\n' % (key, ' '.join(config)))
+
+def _load_status_cache(repo_path, key):
+	try:
+		with open(repo_path + '/' + STATUS_CACHE) as f:
+			lines = f.read().decode('utf-8').split('\n')
+	except IOError:
+		return None
+	if len(lines) < 2 or lines[0] != key:
+		return None
+	return (lines[1], [i for i in lines[2:] if i])
+
+def status_messages(status, summaries):
+	# what gitum status prints, followed by the diff for STATUS_MODIFIED
+	if status == STATUS_LOCAL_CHANGES:
+		return ['error: You have local changes. Run git commit and gitum update to save them, please.']
+	elif status == STATUS_CLEAN:
+		return ['Nothing to update.']
+	elif status == STATUS_NEW_COMMITS:
+		return ['Have new commits, run gitum update to save them:'] + \
+		       ['\t%s' % i for i in summaries]
+	return ['Existing patches were modified.', 'Run gitum update to save the result diff:']
+
+def quick_status(repo_path='.', with_log=False):
+	# gitum status answered from the cached config and status with neither
+	# git nor GitPython, None if a GitUpstream object is needed for it
+	try:
+		config = _load_config_cache(repo_path, _config_key(repo_path))
+		if not config:
+			return None
+		upstream, rebased, mainline, patches = config
+		mainline_sha = read_ref(repo_path + '/.git', mainline)
+		rebased_sha = read_ref(repo_path + '/.git', rebased)
+		current_rebased = _read_line(repo_path + '/' + CURRENT_REBASED)
+		if _read_line(repo_path + '/' + CURRENT_MAINLINE) != mainline_sha:
+			return None
+	except (IOError, NotSupported):
+		return None
+	res = _load_status_cache(repo_path, '%s %s %s' % (mainline_sha, rebased_sha, current_rebased))
+	if not res or res[0] not in [STATUS_CLEAN, STATUS_NEW_COMMITS, STATUS_LOCAL_CHANGES]:
+		return None
+	if with_log:
+		for i in status_messages(*res):
+			print(i)
+	return res[0]
+
+def _timed(stage):
+	# account the wall time of a stage to the upstream commit being merged
+	def wrap(func):
+		def timed(self, *args, **kwargs):
+			if not self._profiler:
+				return func(self, *args, **kwargs)
+			with self._profiler.stage(stage, self._profile_commit):
+				return func(self, *args, **kwargs)
+		return timed
+	return wrap
 
 class GitUpstream(object):
-	def __init__(self, repo_path='.', with_log=False, new_repo=False):
+	def __init__(self, repo_path='.', with_log=False, new_repo=False, worktree=False,
+		     profile=False):
+		_import_git()
+		# object reads go through git cat-file --batch processes that live
+		# as long as the repo object
 		if new_repo:
-			self._repo = Repo.init(repo_path)
+			self._repo = Repo.init(repo_path, odbt=GitCmdObjectDB)
 		else:
-			self._repo = Repo(repo_path)
+			self._repo = Repo(repo_path, odbt=GitCmdObjectDB)
 		self._with_log = with_log
+		self._history = None
+		# gitum files always live in the main repo, while merges may run
+		# in a private work tree sharing its refs
+		self._main_repo = self._repo
+		self._main_head = None
+		if worktree and not new_repo:
+			self._repo = self._open_worktree()
+			if not self._main_repo.head.is_detached:
+				self._main_head = self._main_repo.head.commit.hexsha
+		# branch name -> sha, loaded with one for-each-ref when needed
+		self._refs = None
+		hooked(self._main_repo).hooks.append(self._executed)
+		if self._repo is not self._main_repo:
+			hooked(self._repo).hooks.append(self._executed)
+		self._profiler = None
+		self._profile_commit = None
+		if profile:
+			self._profiler = Profiler()
+			self._profiler.watch(self._main_repo)
+			if self._repo is not self._main_repo:
+				self._profiler.watch(self._repo)
 
 	def repo(self):
 		return self._repo
 
-	def merge(self, mbranch=None, track_with=None):
+	def profile_report(self):
+		if not self._profiler:
+			return None
+		return self._profiler.report()
+
+	def merge(self, mbranch=None, track_with=None, batch=None, replay=False):
 		self._init_merge()
-		if self._repo.is_dirty():
+		self._replay = replay
+		if self._is_dirty():
 			self._log_error('You have local changes. Run git commit and gitum update to save them, please.')
 			raise RepoIsDirty
 		self._load_config()
 		self._check_mainline()
-		if self._repo.git.diff(self._rebased, self._mainline, stdout_as_string=False) != '':
+		if not self._same_tree(self._rebased, self._mainline):
 			self._log_error('You have local commited changes. Run gitum update to save them, please.')
 			raise NotUptodate
 		if not mbranch:
@@ -79,13 +221,13 @@ class GitUpstream(object):
 		if len(self._commits) == 0:
 			self._log('Repository is up to date - nothing to merge.')
 			return
-		self._commits.reverse()
 		self._all_num = len(self._commits)
 		self._save_branches()
-		self._process_commits()
-		self._repo.git.checkout(self._rebased)
+		self._process_commits(batch)
+		self._checkout(self._rebased)
 		self._save_current_rebased(self._rebased)
 		self._save_current_mainline(self._mainline)
+		self._sync_main()
 		self._log('Successfully updated work branches.')
 
 	def abort(self, am=False):
@@ -101,23 +243,27 @@ class GitUpstream(object):
 		except:
 			pass
 		self._restore_branches()
-		self._repo.git.checkout(self._rebased)
+		self._index_history(self._saved_branches[self._patches])
+		self._get_history().truncate(self._saved_branches[self._patches])
 		self._save_current_rebased(self._rebased)
 		self._save_current_mainline(self._mainline)
+		self._sync_main()
 		self._log('Restored work branches.')
 
-	def continue_merge(self, rebase_cmd):
+	def continue_merge(self, rebase_cmd, batch=None, replay=False):
 		self._init_merge()
+		self._replay = replay
 		self._load_config()
 		if not self._load_state():
 			raise NoStateFile
 		if self._state == REBASE_ST:
+			self._profile_commit = self._commits[self._id]
 			tmp_file = tempfile.TemporaryFile()
 			try:
-				diff_str = self._stage2(self._commits[self._id], tmp_file, rebase_cmd)
-				self._stage3(self._commits[self._id], diff_str)
+				diff = self._stage2(self._commits[self._id], tmp_file, rebase_cmd)
+				self._stage3(self._commits[self._id], diff)
 				self._save_repo_state(
-					self._repo.branches[self._mainline].commit.hexsha if diff_str else ''
+					self._branch_sha(self._mainline) if diff else ''
 				)
 				self._id += 1
 				self._cur_num += 1
@@ -137,66 +283,94 @@ class GitUpstream(object):
 		elif self._state != MERGE_ST:
 			self._log_error("Don't support continue not from merge or rebase mode.")
 			raise NotSupported
-		self._process_commits()
-		self._repo.git.checkout(self._rebased)
+		self._process_commits(batch)
+		self._checkout(self._rebased)
 		self._save_current_rebased(self._rebased)
 		self._save_current_mainline(self._mainline)
+		self._sync_main()
 		self._log('Successfully updated work branches.')
 
 	def status(self):
+		status, summaries, diff = self.get_status()
+		for i in status_messages(status, summaries):
+			self._log(i)
+		if status == STATUS_MODIFIED:
+			self._show_diff(*diff)
+		return status
+
+	def get_status(self):
+		# (status, new commit summaries, (mainline, rebased) shas) without
+		# printing anything but errors
 		self._load_config()
-		diff = self._repo.git.diff('--full-index', self._mainline, self._rebased, stdout_as_string=False)
-		ca = self._find_ca(self._load_current_rebased(), self._rebased)
 		self._check_mainline()
-		if diff != '':
-			self._log_error('You have local changes. Run git commit and gitum update to save them, please.')
-			return
-		if self._load_current_rebased() == self._repo.branches[self._rebased].commit.hexsha:
-			self._log('Nothing to update.')
-			return
-		if ca == self._load_current_rebased():
-			new_commits = [i for i in self._repo.iter_commits(ca + '..' + self._rebased)]
-			new_commits.reverse()
-			self._log('Have new commits, run gitum update to save them:')
-			for c_id in new_commits:
-				self._log('\t%s' % c_id.summary)
-		else:
-			self._log('Existing patches were modified.')
-			self._log('Run gitum update to save the result diff:\n%s' % diff)
+		mainline = self._branch_sha(self._mainline)
+		rebased = self._branch_sha(self._rebased)
+		current_rebased = self._load_current_rebased()
+		# the result only depends on these commits, so it is cached
+		key = '%s %s %s' % (mainline, rebased, current_rebased)
+		res = self._load_status(key)
+		if not res:
+			res = self._get_status(mainline, rebased, current_rebased)
+			self._save_status(key, res)
+		return (res[0], res[1], (mainline, rebased))
+
+	def merge_preview(self, mbranch=None):
+		# the branch gitum merge would merge from and the upstream commits
+		# it would apply, oldest first, as (sha, summary, files changed by
+		# our patches too) tuples; remote branches are not fetched
+		self._load_config()
+		if not mbranch:
+			mbranch = self._load_mbranch()
+		ours = set(self._git_cmd(['diff', '--name-only', self._upstream, self._rebased]).split('\n'))
+		ours.discard('')
+		log = self._git_cmd(['log', '--reverse', '--format=%x00%H %s', '--name-only',
+				     '%s..%s' % (self._upstream, mbranch)])
+		res = []
+		for i in log.split('\0')[1:]:
+			lines = i.strip('\n').split('\n')
+			sha, summary = (lines[0].split(' ', 1) + [''])[:2]
+			res.append((sha, summary.decode('utf-8', 'replace'), sorted(ours.intersection(lines[1:]))))
+		return (mbranch, res)
 
 	def update(self, message=''):
-		if self._repo.is_dirty():
+		if self._is_dirty():
 			self._log_error('You have local changes. Commit them and try again, please.')
 			raise RepoIsDirty
 		self._init_merge()
 		self._load_config()
 		self._check_mainline()
 		current_rebased = self._load_current_rebased()
-		if current_rebased == self._repo.branches[self._rebased].commit.hexsha:
+		if current_rebased == self._branch_sha(self._rebased):
 			self._log('Nothing to update.')
 			return
-		diff = self._repo.git.diff('--full-index', self._mainline, self._rebased, stdout_as_string=False)
+		same = self._same_tree(self._mainline, self._rebased)
 		ca = self._find_ca(current_rebased, self._rebased)
 		if ca == current_rebased:
 			new_commits = [i for i in self._repo.iter_commits(ca + '..' + self._rebased)]
-			if len(new_commits) == 0 and diff !='':
+			if len(new_commits) == 0 and not same:
 				self._log_error("You have equal commits betwean mainline and rebased branches.\nBut git diff betwean it brnaches is not a zero string")
 				return
 			new_commits.reverse()
 			for c_id in new_commits:
 				self._log('Applying commit: %s' % c_id.summary)
-				self._repo.git.checkout(self._mainline)
+				self._checkout(self._mainline)
 				self._repo.git.cherry_pick(c_id.hexsha)
-				self._save_repo_state(self._mainline if diff else '', message, c_id.hexsha)
+				self._save_repo_state(self._mainline if not same else '', message, c_id.hexsha)
 		else:
 			self._log('else')
+			diff = None
+			if not same:
+				diff = (self._branch_sha(self._mainline),
+					self._branch_sha(self._rebased))
 			self._diffapply(diff, message)
-		self._repo.git.checkout(self._rebased)
+		self._checkout(self._rebased)
 		self._save_current_rebased(self._rebased)
 		self._save_current_mainline(self._mainline)
+		self._sync_main()
 		self._log('Successfully updated work branches.')
 
 	def create(self, remote, upstream, rebased, mainline, patches):
+		self._refs = None
 		config = True
 		if upstream == UPSTREAM_BRANCH and rebased == REBASED_BRANCH \
 		   and mainline == MAINLINE_BRANCH and patches == PATCHES_BRANCH:
@@ -215,22 +389,27 @@ class GitUpstream(object):
 			raise BranchExists
 		if not self._has_branch(upstream):
 			self._repo.git.branch('-m', upstream)
-		self._repo.git.checkout(upstream)
+		self._checkout(upstream)
 		self._repo.create_head(mainline)
 		self._repo.create_head(rebased)
+		self._refs = None
 		self._save_patches(patches, upstream)
 		if config:
 			self._save_config(mainline, upstream, rebased, patches)
 		self._save_mbranch(remote)
-		self._repo.git.checkout(rebased)
+		self._checkout(rebased)
 		self._save_current_rebased(rebased)
 		self._save_current_mainline(mainline)
 		self._log('Successfully created work branches.')
 
 	def remove_branches(self):
 		self._load_config()
+		if os.path.exists(self._main_repo.git_dir + '/' + WORKTREE_DIR):
+			self._main_repo.git.worktree('remove', '--force',
+						     self._main_repo.git_dir + '/' + WORKTREE_DIR)
+			self._repo = self._main_repo
 		if self._has_branch(self._upstream):
-			self._repo.git.checkout(self._upstream, '-f')
+			self._checkout(self._upstream, '-f')
 		if self._has_branch(self._mainline):
 			self._repo.delete_head(self._mainline, '-D')
 		if self._has_branch(self._rebased):
@@ -244,87 +423,42 @@ class GitUpstream(object):
 		self._log('Successfully removed work branches.')
 
 	def remove_config_files(self):
-		for name in [STATE_FILE, REMOTE_REPO, MERGE_BRANCH, CURRENT_REBASED, CURRENT_MAINLINE]:
-			if os.path.exists(self._repo.working_dir + '/' + name):
-				os.unlink(self._repo.working_dir + '/' + name)
+		for name in [STATE_FILE, REMOTE_REPO, MERGE_BRANCH, CURRENT_REBASED, CURRENT_MAINLINE,
+			     PATCH_CACHE, HISTORY_INDEX, STATUS_CACHE, REBASED_CACHE, CONFIG_CACHE]:
+			if os.path.exists(self._main_repo.working_dir + '/' + name):
+				os.unlink(self._main_repo.working_dir + '/' + name)
 		self._log('Successfully removed gitum config files.')
 
 	def remove_all(self):
 		self.remove_branches()
 		self.remove_config_files()
 
-	def restore(self, commit=None, rebased_only=False):
+	def restore(self, commit=None, rebased_only=False, date=None):
 		self._load_config()
-		if not commit:
+		if date:
+			commit = self._patches_commit_at(date)
+		elif not commit:
 			commit = self._patches
+		patches_commit = self._find_patches_commit(commit)
 		if rebased_only:
-			self._gen_rebased(commit)
+			self._gen_rebased(patches_commit)
 			self._save_current_rebased(self._rebased)
+			self._sync_main()
 			return
-		commits = []
-		ok = False
-		for i in self._repo.iter_commits(commit):
-			commits.append(i.hexsha)
-			if i.message.startswith('gitum-patches: begin'):
-				ok = True
-				break
-		if not ok:
+		commits = self._patches_chain(patches_commit)
+		if not commits or not self._repo.commit(commits[0]).message.startswith('gitum-patches: begin'):
 			self._log_error('Broken %s commit.' % commit)
 			raise BrokenRepo
-		commits.reverse()
-		git = self._repo.git
-		start = commits[0]
-		commits = commits[1:]
-		git.checkout(start)
-		with open(self._repo.working_tree_dir + '/' + UPSTREAM_COMMIT_FILE) as f:
-			tmp_list = f.readlines()
-			if len(tmp_list) > 1:
-				self._log_error('Broken upstream commit file.')
-				raise BrokenRepo
-			upstream_commit = tmp_list[0]
-		git.checkout(upstream_commit)
-		tmp_dir = tempfile.mkdtemp()
-		saved_commit_id = self._repo.head.commit.hexsha
-		for i in commits:
-			git.checkout(i)
-			for j in os.listdir(self._repo.working_tree_dir):
-				if j.endswith('.patch'):
-					shutil.copy(self._repo.working_tree_dir + '/' + j, tmp_dir + '/' + j)
-			shutil.copy(self._repo.working_tree_dir + '/' + LAST_PATCH_FILE, tmp_dir + '/' + LAST_PATCH_FILE)
-			with open(self._repo.working_tree_dir + '/' + UPSTREAM_COMMIT_FILE) as f:
-				tmp_list = f.readlines()
-				if len(tmp_list) > 1:
-					self._log_error('Broken upstream commit file.')
-					raise BrokenRepo
-				upstream_commit = tmp_list[0]
-			git.checkout(saved_commit_id)
-			patch_exists = False
-			with open(tmp_dir + '/' + LAST_PATCH_FILE) as f:
-				if f.readlines():
-					patch_exists = True
-			if patch_exists:
-				self._apply_patch_am(tmp_dir, LAST_PATCH_FILE)
-			os.unlink(tmp_dir + '/' + LAST_PATCH_FILE)
-			saved_commit_id = self._repo.head.commit.hexsha
-		if self._has_branch(self._mainline):
-			self._repo.delete_head(self._mainline, '-D')
-		self._repo.create_head(self._mainline)
-		git.checkout(upstream_commit)
-		if self._has_branch(self._upstream):
-			self._repo.delete_head(self._upstream, '-D')
-		self._repo.create_head(self._upstream)
-		if self._has_branch(self._rebased):
-			self._repo.delete_head(self._rebased, '-D')
-		self._repo.create_head(self._rebased)
-		git.checkout(self._rebased)
-		patches_to_apply = [i for i in os.listdir(tmp_dir) if i.endswith('.patch')]
-		patches_to_apply.sort()
-		for i in patches_to_apply:
-			self._apply_patch_am(tmp_dir, i)
-		shutil.rmtree(tmp_dir)
-		git.checkout(self._rebased)
+		# mainline is replayed from the root upstream commit with all the
+		# saved mainline patches read straight from the object database
+		self._checkout(self._upstream_commit(commits[0]))
+		self._apply_mbox([self._read_object(i + ':' + LAST_PATCH_FILE) for i in commits[1:]])
+		self._set_branch(self._mainline, self._repo.head.commit.hexsha)
+		self._set_branch(self._upstream, self._upstream_commit(commits[-1]))
+		self._gen_rebased(commits[-1])
 		self._save_current_rebased(self._rebased)
 		self._save_current_mainline(self._mainline)
+		self._sync_main()
 		self._log('Successfully restored work branches to %s commit from %s branch.' % (commit, self._patches))
 
 	def clone(self, remote_repo):
@@ -337,13 +471,13 @@ class GitUpstream(object):
 		self._repo.git.fetch('origin')
 		try:
 			self._repo.remotes['origin'].refs[CONFIG_BRANCH]
-			self._repo.git.checkout('-b', CONFIG_BRANCH, 'origin/' + CONFIG_BRANCH)
+			self._checkout('-b', CONFIG_BRANCH, 'origin/' + CONFIG_BRANCH)
 		except:
 			pass
 		self._load_config()
-		self._repo.git.checkout('-b', self._upstream, 'origin/' + self._upstream)
-		self._repo.git.checkout('-b', self._patches, 'origin/' + self._patches)
-		self._repo.git.checkout('-b', self._mainline, 'origin/' + self._mainline)
+		self._checkout('-b', self._upstream, 'origin/' + self._upstream)
+		self._checkout('-b', self._patches, 'origin/' + self._patches)
+		self._checkout('-b', self._mainline, 'origin/' + self._mainline)
 		self._save_remote('origin')
 		self._gen_rebased()
 		self._save_current_rebased(self._rebased)
@@ -359,27 +493,52 @@ class GitUpstream(object):
 		if track_with:
 			self._save_remote(remote)
 		self._save_branches()
-		cur = self._repo.branches[self._patches].commit.hexsha
+		cur = self._branch_sha(self._patches)
 		self._repo.git.fetch(remote)
-		self._repo.git.checkout(self._upstream, '-f')
-		self._repo.git.reset(remote + '/' + self._upstream, '--hard')
-		self._repo.git.checkout(self._patches, '-f')
-		self._repo.git.reset(remote + '/' + self._patches, '--hard')
-		self._repo.git.checkout(self._mainline, '-f')
-		self._repo.git.reset(remote + '/' + self._mainline, '--hard')
+		if self._is_ancestor(cur, remote + '/' + self._patches):
+			self._fast_forward(remote)
+			return
+		self._detach_head()
+		self._update_refs([(i, self._repo.commit(remote + '/' + i).hexsha) for i in
+				   [self._upstream, self._patches, self._mainline]])
 		self._gen_rebased()
 		self._log('Reset work branches to the remote state, applying our commits on top...')
-		self._repo.git.checkout(self._mainline)
-		previd = self._find_ca(remote + '/' + self._patches, cur)
-		self._commits = [q.hexsha for q in self._repo.iter_commits(previd + '..' + cur)]
-		self._commits.reverse()
+		self._checkout(self._mainline)
+		# the history index knows our commits on top of the remote ones
+		# unless the two patches branches have diverged
+		remote_patches = self._repo.commit(remote + '/' + self._patches).hexsha
+		self._commits = self._patches_chain(cur, remote_patches)
+		if self._commits is None:
+			# diverged: start from the latest commit of both branches
+			self._index_history(remote_patches)
+			previd = self._get_history().common(cur, remote_patches)
+			if not previd:
+				previd = self._find_ca(remote_patches, cur)
+			self._commits = self._patches_chain(cur, previd)
+		if self._commits is None:
+			self._commits = [q.hexsha for q in self._repo.iter_commits(previd + '..' + cur)]
+			self._commits.reverse()
 		self._all_num = len(self._commits)
 		self._pull_commits()
-		self._repo.git.checkout(self._rebased)
+		self._checkout(self._rebased)
 		self._save_current_rebased(self._rebased)
 		self._save_current_mainline(self._mainline)
+		self._sync_main()
 		self._log('Successfully updated work branches.')
 
+	def _fast_forward(self, remote):
+		# Nothing of ours is missing on the remote side: take its
+		# branches as they are. The rebased branch is rebuilt only from
+		# the patches that were never applied on top of the same ones.
+		self._detach_head()
+		self._update_refs([(i, self._repo.commit(remote + '/' + i).hexsha) for i in
+				   [self._upstream, self._patches, self._mainline]])
+		self._gen_rebased()
+		self._save_current_rebased(self._rebased)
+		self._save_current_mainline(self._mainline)
+		self._sync_main()
+		self._log('Fast-forwarded work branches to %s.' % remote)
+
 	def continue_pull(self, command):
 		self._load_config()
 		self._init_merge()
@@ -388,20 +547,8 @@ class GitUpstream(object):
 		try:
 			tmp_file = tempfile.TemporaryFile()
 			self._repo.git.am(command, output_stream=tmp_file)
-			if command == '--resolved':
-				self._repo.git.checkout(self._rebased)
-				self._repo.git.cherry_pick(self._mainline)
-				self._save_repo_state(self._mainline)
-			self._repo.git.checkout(self._upstream, '-f')
-			self._repo.git.merge(
-				self._repo.git.show(
-					self._commits[self._id] + ':' + UPSTREAM_COMMIT_FILE,
-					stdout_as_string=False
-				)
-			)
-			self._repo.git.checkout(self._mainline)
-			self._id += 1
-			self._cur_num += 1
+			# am goes on with the rest of the run
+			self._finish_pull_run(self._pull_run())
 		except GitCommandError as e:
 			self._save_state()
 			tmp_file.seek(0)
@@ -412,9 +559,10 @@ class GitUpstream(object):
 			self._save_state()
 			raise
 		self._pull_commits()
-		self._repo.git.checkout(self._rebased)
+		self._checkout(self._rebased)
 		self._save_current_rebased(self._rebased)
 		self._save_current_mainline(self._mainline)
+		self._sync_main()
 		self._log('Successfully updated work branches.')
 
 	def push(self, remote=None, track_with=None):
@@ -432,8 +580,67 @@ class GitUpstream(object):
 			self._repo.git.push(remote, CONFIG_BRANCH)
 		self._log('Successfully pushed work branches.')
 
+	def _open_worktree(self):
+		if self._repo.git.version_info < WORKTREE_GIT_VERSION:
+			self._log_error('--worktree needs git %s or newer.' %
+					'.'.join([str(i) for i in WORKTREE_GIT_VERSION]))
+			raise NotSupported
+		path = self._repo.git_dir + '/' + WORKTREE_DIR
+		if not os.path.exists(path + '/.git'):
+			self._repo.git.worktree('prune')
+			self._repo.git.worktree('add', '--detach', path)
+		return Repo(path, odbt=GitCmdObjectDB)
+
+	def _checkout(self, *args):
+		if self._repo is not self._main_repo:
+			args = ('--ignore-other-worktrees',) + args
+		self._repo.git.checkout(*args)
+
+	def _is_dirty(self):
+		return self._repo.is_dirty() or self._main_repo.is_dirty()
+
+	def _sync_main(self, detach=True):
+		# bring the user's checkout up to date if the branch it is on was
+		# moved in the private work tree; once done, the private work tree
+		# lets go of our branches so that they can be checked out there
+		if detach and self._repo is not self._main_repo:
+			self._repo.git.checkout('--detach')
+		if not self._main_head:
+			return
+		head = self._main_repo.head.commit.hexsha
+		if head == self._main_head:
+			return
+		try:
+			self._main_repo.git.read_tree('-m', '-u', self._main_head, head)
+			self._main_head = head
+		except GitCommandError as e:
+			self._log_error('Can not update %s work tree to %s.' %
+					(self._main_repo.working_tree_dir, head))
+			self._log(e.stderr)
+
 	def _has_branch(self, head):
-		return self._repo.branches.count(Head(head, "refs/heads/" + head, True)) == 1
+		return head in self._ref_snapshot()
+
+	def _ref_snapshot(self):
+		if self._refs is None:
+			self._refs = {}
+			out = self._git_cmd(['for-each-ref', '--format=%(objectname) %(refname)',
+					     'refs/heads/'])
+			for i in out.splitlines():
+				sha, name = i.split(' ', 1)
+				self._refs[name[len('refs/heads/'):]] = sha
+		return self._refs
+
+	def _branch_sha(self, branch):
+		try:
+			return self._ref_snapshot()[branch]
+		except KeyError:
+			raise IndexError('No branch %s' % branch)
+
+	def _executed(self, command, elapsed, res):
+		# anything but our own ref updates drops the snapshot
+		if subcommand(command) in REF_COMMANDS:
+			self._refs = None
 
 	def _has_hostname(self, repo_path):
 		if repo_path.find(':') == -1:
@@ -443,36 +650,125 @@ class GitUpstream(object):
 	def _gen_rebased(self, commit=''):
 		if not commit:
 			commit = self._patches
-		self._repo.git.checkout(commit)
-		tmp_dir = tempfile.mkdtemp()
-		for j in os.listdir(self._repo.working_tree_dir):
-			if j.endswith('.patch'):
-				shutil.copy(self._repo.working_tree_dir + '/' + j, tmp_dir + '/' + j)
-		if self._has_branch(self._rebased):
-			self._repo.delete_head(self._rebased, '-D')
-		self._repo.git.checkout('-b', self._rebased,
-			self._repo.git.show(
-				commit + ':' + UPSTREAM_COMMIT_FILE,
-				stdout_as_string=False
-			)
-		)
-		patches_to_apply = [i for i in os.listdir(tmp_dir) if i.endswith('.patch')]
-		patches_to_apply.sort()
-		for i in patches_to_apply:
-			self._apply_patch_am(tmp_dir, i)
-		shutil.rmtree(tmp_dir)
+		patches = sorted([i for i in self._ls_tree(commit) if i[3].endswith('.patch')],
+				 key=lambda i: i[3])
+		upstream = self._upstream_commit(commit)
+		keys = self._rebased_keys(upstream, [i[2] for i in patches])
+		# start from the longest prefix of the stack built before
+		cache = self._load_rebased_cache()
+		base, done = upstream, 0
+		for num in xrange(len(keys), 0, -1):
+			if keys[num - 1] in cache and self._has_object(cache[keys[num - 1]]):
+				base, done = cache[keys[num - 1]], num
+				break
+		self._checkout('-B', self._rebased, base)
+		if done:
+			self._log('Reused %d of %d patches.' % (done, len(patches)))
+		for i in patches[done:]:
+			self._log('Applying patch: ' + i[3])
+		self._apply_mbox([self._read_object(i[2]) for i in patches[done:]])
+		if done < len(patches):
+			built = self._git_cmd(['rev-list', '--reverse', '%s..HEAD' % base]).split()
+			if len(built) == len(patches) - done:
+				self._cache_rebased(keys[done:], built, cache)
+
+	def _rebased_keys(self, upstream, blobs):
+		# a key for every prefix of the patch stack on top of upstream
+		keys = []
+		key = upstream
+		for i in blobs:
+			key = hashlib.sha1(key + ' ' + i).hexdigest()
+			keys.append(key)
+		return keys
+
+	def _load_rebased_cache(self):
+		cache = {}
+		try:
+			with open(self._main_repo.working_dir + '/' + REBASED_CACHE) as f:
+				for i in f:
+					parts = i.split()
+					if len(parts) == 2:
+						cache[parts[0]] = parts[1]
+		except IOError:
+			pass
+		return cache
+
+	def _cache_rebased(self, keys, commits, cache=None):
+		# (upstream, patch blobs prefix) key -> the rebased commit for it
+		if cache is None:
+			cache = self._load_rebased_cache()
+		with open(self._main_repo.working_dir + '/' + REBASED_CACHE, 'a') as f:
+			for key, commit in zip(keys, commits):
+				if cache.get(key) != commit:
+					f.write('%s %s\n' % (key, commit))
+					cache[key] = commit
+
+	def _cache_stack(self, upstream, patches):
+		# the saved stack maps to the rebased commits only if they are a
+		# linear history right on top of upstream
+		prev = upstream
+		for i in patches:
+			if i[4] != prev:
+				return
+			prev = i[3]
+		self._cache_rebased(self._rebased_keys(upstream, [i[1] for i in patches]),
+				    [i[3] for i in patches])
+
+	def _upstream_commit(self, commit):
+		lines = self._read_object(commit + ':' + UPSTREAM_COMMIT_FILE).splitlines()
+		if len(lines) != 1:
+			self._log_error('Broken upstream commit file.')
+			raise BrokenRepo
+		return lines[0].strip()
+
+	def _apply_mbox(self, patches, args=[], output=None):
+		# feed all the patches to a single git am session
+		mbox = ''.join([i if i.endswith('\n') else i + '\n' for i in patches if i])
+		if mbox:
+			self._git_cmd(['am'] + args, mbox, output=output)
+
+	def _get_status(self, mainline, rebased, current_rebased):
+		if not self._same_tree(mainline, rebased):
+			return (STATUS_LOCAL_CHANGES, [])
+		if current_rebased == rebased:
+			return (STATUS_CLEAN, [])
+		if self._find_ca(current_rebased, rebased) == current_rebased:
+			new_commits = [i.summary for i in self._repo.iter_commits(current_rebased + '..' + rebased)]
+			new_commits.reverse()
+			return (STATUS_NEW_COMMITS, new_commits)
+		return (STATUS_MODIFIED, [])
+
+	def _load_status(self, key):
+		return _load_status_cache(self._main_repo.working_dir, key)
+
+	def _save_status(self, key, res):
+		status, summaries = res
+		with open(self._main_repo.working_dir + '/' + STATUS_CACHE, 'w') as f:
+			f.write('\n'.join([key, status] + summaries).encode('utf-8') + '\n')
+
+	def _show_diff(self, c1, c2):
+		# let git stream the diff to its pager instead of reading it here
+		if not self._with_log:
+			return
+		sys.stdout.flush()
+		call(['git', 'diff', '--full-index', c1, c2], cwd=self._repo.working_tree_dir)
+
+	def _tree_id(self, rev):
+		return self._repo.git.get_object_header(rev + '^{tree}')[0]
+
+	def _same_tree(self, c1, c2):
+		# equal tree ids mean no difference, without rendering a diff
+		return self._tree_id(c1) == self._tree_id(c2)
 
 	def _find_ca(self, c1, c2):
 		return self._repo.git.merge_base(c1, c2)
 
 	def _save_parm(self, filename, parm):
-		with open(self._repo.working_dir + '/' + filename, 'w') as f:
+		with open(self._main_repo.working_dir + '/' + filename, 'w') as f:
 			f.write(parm)
 
 	def _load_parm(self, filename):
-		with open(self._repo.working_dir + '/' + filename) as f:
-			parm = f.readline().strip()
-		return parm
+		return _read_line(self._main_repo.working_dir + '/' + filename)
 
 	def _save_remote(self, remote):
 		self._save_parm(REMOTE_REPO, remote)
@@ -495,22 +791,22 @@ class GitUpstream(object):
 			raise NoMergeBranch
 
 	def _save_current_rebased(self, rebased):
-		self._save_parm(CURRENT_REBASED, self._repo.branches[rebased].commit.hexsha)
+		self._save_parm(CURRENT_REBASED, self._branch_sha(rebased))
 
 	def _load_current_rebased(self):
 		return self._load_parm(CURRENT_REBASED)
 
 	def _save_current_mainline(self, mainline):
-		self._save_parm(CURRENT_MAINLINE, self._repo.branches[mainline].commit.hexsha)
+		self._save_parm(CURRENT_MAINLINE, self._branch_sha(mainline))
 
 	def _load_current_mainline(self):
 		return self._load_parm(CURRENT_MAINLINE)
 
 	def _check_mainline(self):
 		current_mainline = self._load_current_mainline()
-		if current_mainline != self._repo.branches[self._mainline].commit.hexsha:
+		if current_mainline != self._branch_sha(self._mainline):
 			self._log_unexpected_head(self._mainline,
-						  self._repo.branches[self._mainline].commit.hexsha,
+						  self._branch_sha(self._mainline),
 						  current_mainline)
 			raise RepoIsDirty
 
@@ -524,34 +820,19 @@ class GitUpstream(object):
 	def _pull_commits(self):
 		tmp_file = tempfile.TemporaryFile()
 		try:
-			for q in xrange(self._id, len(self._commits)):
-				lines = self._repo.git.show(
-						self._commits[q] + ':' + LAST_PATCH_FILE,
-						stdout_as_string=False
-					)
-				if len(lines) > 0:
-					tmp_dir = tempfile.mkdtemp()
-					with open(tmp_dir + '/' + TMP_LAST_PATCH_FILE, 'w') as f:
-						f.write(lines)
-					self._log('Applying commit: %s' % self._get_commit_name_from_patch(lines))
-					self._repo.git.am('-3', tmp_dir + '/' + TMP_LAST_PATCH_FILE,
-							  output_stream=tmp_file)
-					self._repo.git.checkout(self._rebased)
-					self._repo.git.cherry_pick(self._mainline)
-					self._save_repo_state(self._mainline)
-					shutil.rmtree(tmp_dir)
-				self._repo.git.checkout(self._upstream)
-				self._repo.git.merge(
-					self._repo.git.show(
-						self._commits[q] + ':' + UPSTREAM_COMMIT_FILE,
-						stdout_as_string=False
-					)
-				)
-				self._repo.git.checkout(self._mainline)
+			while self._id < len(self._commits):
+				end = self._pull_run()
+				patches = [self._read_object(i + ':' + LAST_PATCH_FILE)
+					   for i in self._commits[self._id:end]]
+				for i in patches:
+					if i:
+						self._log('Applying commit: %s' % self._get_commit_name_from_patch(i))
+				# continue_pull picks the run from here if am stops
+				self._saved_branches['prev_head'] = self._branch_sha(self._mainline)
+				self._apply_mbox(patches, ['-3'], tmp_file)
+				self._finish_pull_run(end)
 				tmp_file.close()
 				tmp_file = tempfile.TemporaryFile()
-				self._id += 1
-				self._cur_num += 1
 		except GitCommandError as e:
 			self._save_state()
 			tmp_file.seek(0)
@@ -562,40 +843,144 @@ class GitUpstream(object):
 			self._save_state()
 			raise
 
+	def _pull_run(self):
+		# Commits from the current one that are applied in a single am
+		# session: upstream has to stay the same while they are applied,
+		# so the run ends with the first commit that moves it.
+		upstream = self._branch_sha(self._upstream)
+		end = self._id
+		while end < len(self._commits):
+			end += 1
+			if self._upstream_commit(self._commits[end - 1]) != upstream:
+				break
+		return end
+
+	def _finish_pull_run(self, end):
+		prev_head = self._saved_branches['prev_head']
+		if self._branch_sha(self._mainline) != prev_head:
+			self._checkout(self._rebased)
+			self._repo.git.cherry_pick('%s..%s' % (prev_head, self._mainline))
+			self._save_repo_state(self._mainline, since=prev_head)
+		self._advance(self._upstream, self._upstream_commit(self._commits[end - 1]))
+		self._checkout(self._mainline)
+		self._cur_num += end - self._id
+		self._id = end
+
+	def _git_cmd(self, args, data=None, env=None, output=None):
+		cmd_env = None
+		if env:
+			cmd_env = os.environ.copy()
+			cmd_env.update(env)
+		start = time.time()
+		proc = Popen(['git'] + args, cwd=self._repo.working_tree_dir,
+			     stdin=PIPE, stdout=output or PIPE, stderr=PIPE, env=cmd_env)
+		out, err = proc.communicate(data)
+		if args[0] in REF_COMMANDS and args[0] != 'update-ref':
+			self._refs = None
+		self._command_done(args[0], start, len(out or ''))
+		if proc.returncode != 0:
+			raise GitCommandError(['git'] + args, proc.returncode, err)
+		return out
+
+	def _git_lines(self, args):
+		# the output of git streamed line by line
+		start = time.time()
+		proc = Popen(['git'] + args, cwd=self._repo.working_tree_dir, stdout=PIPE, stderr=PIPE)
+		nbytes = 0
+		for line in proc.stdout:
+			nbytes += len(line)
+			yield line
+		err = proc.stderr.read()
+		proc.wait()
+		self._command_done(args[0], start, nbytes)
+		if proc.returncode != 0:
+			raise GitCommandError(['git'] + args, proc.returncode, err)
+
+	def _call(self, args, **kwargs):
+		# git attached to the terminal, e.g. to run an editor
+		start = time.time()
+		res = call(['git'] + args, cwd=self._repo.working_tree_dir, **kwargs)
+		self._refs = None
+		self._command_done(args[0], start)
+		return res
+
+	def _command_done(self, name, start, nbytes=0):
+		# account a git process started here rather than by GitPython
+		if self._profiler:
+			self._profiler.command(name, time.time() - start, nbytes)
+
+	def _hash_files(self, paths):
+		if not paths:
+			return []
+		return self._git_cmd(['hash-object', '-w', '--'] + paths).split()
+
+	def _mktree(self, entries):
+		data = ''.join(['%s %s %s\t%s\n' % i for i in entries])
+		return self._git_cmd(['mktree'], data).strip()
+
+	def _read_object(self, rev):
+		return self._repo.git.get_object_data(rev)[3]
+
+	def _has_object(self, rev):
+		try:
+			self._repo.git.get_object_header(rev)
+		except ValueError:
+			return False
+		return True
+
+	def _ls_tree(self, tree):
+		# parse the raw tree object instead of running ls-tree
+		data = self._read_object(tree + '^{tree}')
+		entries = []
+		pos = 0
+		while pos < len(data):
+			end = data.index('\0', pos)
+			mode, name = data[pos:end].split(' ', 1)
+			sha = binascii.hexlify(data[end + 1:end + 21])
+			pos = end + 21
+			if mode == '40000':
+				entries.append(('040000', 'tree', sha, name))
+			elif mode == '160000':
+				entries.append((mode, 'commit', sha, name))
+			else:
+				entries.append((mode, 'blob', sha, name))
+		return entries
+
+	def _commit_tree(self, tree, message, parents=[], author=None, date=None):
+		args = ['commit-tree', tree]
+		for i in parents:
+			args += ['-p', i]
+		env = {}
+		if author:
+			env['GIT_AUTHOR_NAME'] = author.name.encode('utf-8')
+			env['GIT_AUTHOR_EMAIL'] = author.email.encode('utf-8')
+		if date:
+			env['GIT_AUTHOR_DATE'] = date
+		return self._git_cmd(args, message.strip() + '\n', env).strip()
+
+	def _set_branch(self, branch, new, old=None):
+		args = ['update-ref', 'refs/heads/' + branch, new]
+		if old:
+			args.append(old)
+		self._git_cmd(args)
+		self._ref_moved(branch, new)
+
+	def _ref_moved(self, branch, new):
+		if self._refs is not None:
+			if len(new) == 40:
+				self._refs[branch] = new
+			else:
+				self._refs = None
+
 	def _save_patches(self, patches, upstream):
 		# create blob
 		tmp_dir = tempfile.mkdtemp()
 		with open(tmp_dir + '/' + UPSTREAM_COMMIT_FILE, 'w') as f:
-			f.write(self._repo.branches[upstream].commit.hexsha)
-		blob = self._repo.git.hash_object('-w', tmp_dir + '/' + UPSTREAM_COMMIT_FILE)
-		# create tree
-		in_file = tempfile.TemporaryFile()
-		out_file = tempfile.TemporaryFile()
-		in_file.write(('100644 blob %s\t' + UPSTREAM_COMMIT_FILE) % blob)
-		in_file.seek(0)
-		proc = Popen(['git', '--git-dir=' + self._repo.working_dir + '/.git/',
-			      '--work-tree=' + self._repo.working_tree_dir, 'mktree'],
-			      stdin=in_file, stdout=out_file)
-		status = proc.wait()
-		if status != 0:
-			self._log(status)
-		out_file.seek(0)
-		tree=out_file.readline().strip()
-		in_file.close()
-		out_file.close()
-		# create commit
-		in_file = tempfile.TemporaryFile()
-		in_file.write('gitum-patches: begin')
-		in_file.seek(0)
-		out_file = tempfile.TemporaryFile()
-		proc = Popen(['git', '--git-dir=' + self._repo.working_dir + '/.git/',
-			      '--work-tree=' + self._repo.working_tree_dir, 'commit-tree', tree],
-			      stdin=in_file, stdout=out_file)
-		status = proc.wait()
-		if status != 0:
-			self._log(status)
-		out_file.seek(0)
-		commit=out_file.readline().strip()
+			f.write(self._branch_sha(upstream))
+		blob = self._hash_files([tmp_dir + '/' + UPSTREAM_COMMIT_FILE])[0]
+		# create tree and commit
+		tree = self._mktree([('100644', 'blob', blob, UPSTREAM_COMMIT_FILE)])
+		commit = self._commit_tree(tree, 'gitum-patches: begin')
 		self._repo.git.branch(patches, commit)
 		shutil.rmtree(tmp_dir)
 
@@ -607,94 +992,186 @@ class GitUpstream(object):
 			f.write('upstream = %s\n' % upstream)
 			f.write('rebased = %s\n' % rebased)
 			f.write('patches = %s\n' % patches)
-		blob = self._repo.git.hash_object('-w', tmp_dir + '/' + CONFIG_FILE)
-		# create tree
-		in_file = tempfile.TemporaryFile()
-		out_file = tempfile.TemporaryFile()
-		in_file.write(('100644 blob %s\t' + CONFIG_FILE) % blob)
-		in_file.seek(0)
-		proc = Popen(['git', '--git-dir=' + self._repo.working_dir + '/.git/',
-			      '--work-tree=' + self._repo.working_tree_dir, 'mktree'],
-			      stdin=in_file, stdout=out_file)
-		status = proc.wait()
-		if status != 0:
-			self._log(status)
-		out_file.seek(0)
-		tree=out_file.readline().strip()
-		in_file.close()
-		out_file.close()
-		# create commit
-		in_file = tempfile.TemporaryFile()
-		in_file.write('Save config file')
-		in_file.seek(0)
-		out_file = tempfile.TemporaryFile()
-		proc = Popen(['git', '--git-dir=' + self._repo.working_dir + '/.git/',
-			      '--work-tree=' + self._repo.working_tree_dir, 'commit-tree', tree],
-			      stdin=in_file, stdout=out_file)
-		status = proc.wait()
-		if status != 0:
-			self._log(status)
-		out_file.seek(0)
-		commit=out_file.readline().strip()
+		blob = self._hash_files([tmp_dir + '/' + CONFIG_FILE])[0]
+		# create tree and commit
+		tree = self._mktree([('100644', 'blob', blob, CONFIG_FILE)])
+		commit = self._commit_tree(tree, 'Save config file')
 		self._repo.git.branch(CONFIG_BRANCH, commit)
 		shutil.rmtree(tmp_dir)
 
-	def _save_repo_state(self, commit, message='', cur_rebased=None):
+	def _load_patch_cache(self):
+		cache = {}
+		try:
+			with open(self._main_repo.working_dir + '/' + PATCH_CACHE) as f:
+				for i in f:
+					parts = i.split()
+					if len(parts) == 4:
+						cache[parts[0]] = (parts[1], parts[2], parts[3])
+		except IOError:
+			pass
+		return cache
+
+	def _save_patch_cache(self, cache):
+		with open(self._main_repo.working_dir + '/' + PATCH_CACHE, 'w') as f:
+			for commit, entry in cache.iteritems():
+				f.write('%s %s %s %s\n' % ((commit,) + entry))
+
+	def _gen_patches(self, rebased_c):
+		# Render the patch stack as (file name, blob, patch-id, commit,
+		# parent). A rendered patch depends only on its commit (whose sha
+		# covers the parent too), so patches are stored unnumbered and
+		# cached by commit:
+		# only commits that are new since the previous save hit
+		# format-patch, the rest reuse their blobs.
+		lines = self._git_cmd(['rev-list', '--reverse', '--no-merges', '--parents',
+				       '%s..%s' % (self._upstream, rebased_c)]).splitlines()
+		stack = [i.split()[0] for i in lines]
+		parents = [(i.split()[1:] or [None])[0] for i in lines]
+		cache = self._load_patch_cache()
+		for i in stack:
+			if i in cache and not self._has_object(cache[i][0]):
+				del cache[i]
+		runs = []
+		for num, commit in enumerate(stack):
+			if commit in cache:
+				continue
+			if runs and runs[-1][1] == num:
+				runs[-1][1] = num + 1
+			else:
+				runs.append([num, num + 1])
+		if runs:
+			tmp_dir = tempfile.mkdtemp()
+			try:
+				for start, end in runs:
+					if start == 0 and end == len(stack):
+						rev_range = '%s..%s' % (self._upstream, rebased_c)
+					else:
+						rev_range = '%s^..%s' % (stack[start], stack[end - 1])
+					self._git_cmd(['format-patch', '-N', '-o', tmp_dir,
+						       '--start-number', str(start + 1), rev_range])
+				names = sorted([i for i in os.listdir(tmp_dir) if i.endswith('.patch')])
+				missing = [i for i in stack if i not in cache]
+				if len(names) != len(missing):
+					self._log_error('Unexpected number of patches generated for %s.' % rebased_c)
+					raise BrokenRepo
+				blobs = self._hash_files([tmp_dir + '/' + i for i in names])
+				ids = {}
+				data = ''
+				for i in names:
+					with open(tmp_dir + '/' + i) as f:
+						data += f.read()
+				for i in self._git_cmd(['patch-id', '--stable'], data).splitlines():
+					ids[i.split()[1]] = i.split()[0]
+				for commit, name, blob in zip(missing, names, blobs):
+					cache[commit] = (blob, name.split('-', 1)[1], ids.get(commit, '-'))
+			finally:
+				shutil.rmtree(tmp_dir)
+		patches = []
+		new_cache = {}
+		for num, commit in enumerate(stack):
+			blob, name, patch_id = cache[commit]
+			patches.append(('%04d-%s' % (num + 1, name), blob, patch_id, commit, parents[num]))
+			new_cache[commit] = cache[commit]
+		self._save_patch_cache(new_cache)
+		return patches
+
+	@_timed('save_repo_state')
+	def _save_repo_state(self, commit, message='', cur_rebased=None, since=None):
 		mainline_c = commit if commit else self._mainline
 		rebased_c = cur_rebased if cur_rebased else self._rebased
-		if self._repo.git.diff(rebased_c, mainline_c, stdout_as_string=False) != '':
+		if not self._stale and not self._same_tree(rebased_c, mainline_c):
 			self._log_error('%s and %s work trees are not equal - can\'t save state!' %
 					(rebased_c, mainline_c))
 			raise NotUptodate
-		# create tmp dir
+		# the patches branch is built at the object level: neither the
+		# work tree nor the index are touched here
+		patches = self._gen_patches(rebased_c)
 		tmp_dir = tempfile.mkdtemp()
-		git = self._repo.git
-		# generate new patches
-		for i in os.listdir(self._repo.working_tree_dir):
-			if i.endswith('.patch'):
-				os.unlink(self._repo.working_tree_dir + '/' + i)
-		git.format_patch('%s..%s' % (self._upstream, rebased_c))
-		# move patches to tmp dir
-		for i in os.listdir(self._repo.working_tree_dir):
-			if i.endswith('.patch'):
-				shutil.move(self._repo.working_tree_dir + '/' + i,
-					    tmp_dir + '/' + i)
-		# get mainline branch commit
-		if commit:
-			git.format_patch('%s^..%s' % (commit, commit))
-		else:
-			with open(self._repo.working_tree_dir + '/' + TMP_LAST_PATCH_FILE, 'w') as f:
-				pass
-		# move it to tmp dir
-		for i in os.listdir(self._repo.working_tree_dir):
-			if i.endswith('.patch'):
-				shutil.move(self._repo.working_tree_dir + '/' + i,
-					    tmp_dir + '/' + LAST_PATCH_FILE)
-		git.checkout(self._patches, '-f')
-		# remove old patches from patches branch
-		git.rm(self._repo.working_tree_dir + '/*.patch', '--ignore-unmatch')
-		# move new patches from tmp dir to patches branch
-		for i in os.listdir(tmp_dir):
-			if i.endswith('.patch'):
-				shutil.move(tmp_dir + '/' + i, self._repo.working_tree_dir + '/' + i)
-		shutil.move(tmp_dir + '/' + LAST_PATCH_FILE,
-			    self._repo.working_tree_dir + '/' + LAST_PATCH_FILE)
-		# update upstream head
-		with open(self._repo.working_tree_dir + '/' + UPSTREAM_COMMIT_FILE, 'w') as f:
-			f.write(self._repo.branches[self._upstream].commit.hexsha)
+		try:
+			# get mainline branch commit
+			with open(tmp_dir + '/' + LAST_PATCH_FILE, 'w') as f:
+				if commit:
+					f.write(self._git_cmd(['format-patch', '--stdout',
+							       '%s..%s' % (since or commit + '^', commit)]))
+			# update upstream head
+			with open(tmp_dir + '/' + UPSTREAM_COMMIT_FILE, 'w') as f:
+				f.write(self._branch_sha(self._upstream))
+			blobs = self._hash_files([tmp_dir + '/' + LAST_PATCH_FILE,
+						  tmp_dir + '/' + UPSTREAM_COMMIT_FILE])
+		finally:
+			shutil.rmtree(tmp_dir)
+		# keep everything except old patches from patches branch
+		parent = self._branch_sha(self._patches)
+		entries = [i for i in self._ls_tree(parent) if not i[3].endswith('.patch') and
+			   i[3] not in (LAST_PATCH_FILE, UPSTREAM_COMMIT_FILE)]
+		for name, blob in [i[:2] for i in patches] + zip([LAST_PATCH_FILE, UPSTREAM_COMMIT_FILE], blobs):
+			entries.append(('100644', 'blob', blob, name))
+		tree = self._mktree(entries)
 		# commit the result
-		git.add(self._repo.working_tree_dir)
 		mess = message
 		if not mess and commit:
 			mess = self._repo.commit(commit).message.encode('utf-8')
 		if not mess:
 			mess = '%s branch updated without code changes' % self._rebased
-		if commit:
-			author = self._repo.commit(commit).author
-			git.commit('-m', mess, '--author="%s <%s>"' % (author.name, author.email))
-		else:
-			git.commit('-m', mess)
-		shutil.rmtree(tmp_dir)
+		author = self._repo.commit(commit).author if commit else None
+		new = self._commit_tree(tree, mess, [parent], author)
+		self._set_branch(self._patches, new, parent)
+		if not self._stale:
+			self._cache_stack(self._branch_sha(self._upstream), patches)
+		prev = self._index_history(parent)
+		self._get_history().add(new, parent, prev.root, prev.position + 1,
+					self._branch_sha(self._upstream),
+					self._branch_sha(self._mainline),
+					int(time.time()), [i[2] for i in patches])
+
+	def _get_history(self):
+		if not self._history:
+			self._history = PatchesHistory(self._main_repo.working_dir + '/' + HISTORY_INDEX)
+		return self._history
+
+	def _index_history(self, commit):
+		# make sure commit and all its patches branch ancestors are indexed
+		history = self._get_history()
+		if history.get(commit):
+			return history.get(commit)
+		shas = self._git_cmd(['rev-list', '--reverse', '--first-parent', commit]).split()
+		parent = None
+		for num, sha in enumerate(shas):
+			if not history.get(sha):
+				history.add(sha, parent, shas[0], num, self._upstream_commit(sha), None,
+					    self._repo.commit(sha).committed_date)
+			parent = sha
+		return history.get(commit)
+
+	def _find_patches_commit(self, commit):
+		# commit may also be an upstream or mainline commit we saved a
+		# state for
+		sha = self._repo.commit(commit).hexsha
+		history = self._get_history()
+		if not history.get(sha):
+			entry = history.by_mainline(sha) or history.by_upstream(sha)
+			if entry:
+				return entry.commit
+			if not self._has_object(sha + ':' + UPSTREAM_COMMIT_FILE):
+				self._log_error('Broken %s commit.' % commit)
+				raise BrokenRepo
+		return sha
+
+	def _patches_commit_at(self, date):
+		# the latest state saved on the patches branch at or before date,
+		# given in any format git understands
+		since = self._git_cmd(['rev-parse', '--since=' + date]).strip()
+		timestamp = int(since.split('=', 1)[1])
+		tip = self._index_history(self._branch_sha(self._patches))
+		for entry in self._get_history().before_date(timestamp):
+			if entry.root == tip.root and self._is_ancestor(entry.commit, tip.commit):
+				return entry.commit
+		self._log_error('No state of %s branch saved at %s.' % (self._patches, date))
+		raise BrokenRepo
+
+	def _patches_chain(self, commit, stop=None):
+		self._index_history(commit)
+		return self._get_history().chain(commit, stop)
 
 	def _fixup_merge_message(self, mess):
 		mess = mess.replace('git rebase --continue', 'gitum merge --continue')
@@ -709,19 +1186,34 @@ class GitUpstream(object):
 		return mess
 
 	def _load_config(self):
+		# every command starts with a fresh view of the branches
+		self._refs = None
+		# the parsed config is cached for the sha of the config branch
+		repo_path = self._main_repo.working_dir
+		try:
+			key = _config_key(repo_path)
+		except NotSupported:
+			key = None
+		config = key and _load_config_cache(repo_path, key)
+		if not config:
+			config = self._read_config()
+			if key:
+				_save_config_cache(repo_path, key, config)
+		self._upstream, self._rebased, self._mainline, self._patches = config
+
+	def _read_config(self):
 		# set defaults
-		self._upstream = UPSTREAM_BRANCH
-		self._rebased = REBASED_BRANCH
-		self._mainline = MAINLINE_BRANCH
-		self._patches = PATCHES_BRANCH
+		config = {
+			'upstream': UPSTREAM_BRANCH,
+			'rebased': REBASED_BRANCH,
+			'current': MAINLINE_BRANCH,
+			'patches': PATCHES_BRANCH,
+		}
 		# load config
 		try:
-			lines = self._repo.git.show(
-				CONFIG_BRANCH + ':' + CONFIG_FILE,
-				stdout_as_string=False
-			).split('\n')
+			lines = self._read_object(CONFIG_BRANCH + ':' + CONFIG_FILE).splitlines()
 		except:
-			return
+			lines = []
 		num = 0
 		for i in lines:
 			num += 1
@@ -729,44 +1221,72 @@ class GitUpstream(object):
 			if len(parts) != 3 or parts[1] != '=':
 				self._log('error in config file on line %d :' % num)
 				self._log('    %s' % i)
-			if parts[0] == 'upstream':
-				self._upstream = parts[2]
-			elif parts[0] == 'rebased':
-				self._rebased = parts[2]
-			elif parts[0] == 'current':
-				self._mainline = parts[2]
-			elif parts[0] == 'patches':
-				self._patches = parts[2]
+			if parts[0] in config:
+				config[parts[0]] = parts[2]
+		return (config['upstream'], config['rebased'], config['current'], config['patches'])
 
 	def _restore_branches(self):
-		git = self._repo.git
-		git.checkout(self._upstream, '-f')
-		git.reset(self._saved_branches[self._upstream], '--hard')
-		git.checkout(self._rebased, '-f')
-		git.reset(self._saved_branches[self._rebased], '--hard')
-		git.checkout(self._mainline, '-f')
-		git.reset(self._saved_branches[self._mainline], '--hard')
-		git.checkout(self._patches, '-f')
-		git.reset(self._saved_branches[self._patches], '--hard')
+		# move all the work branches back at once and check out only the
+		# rebased one, dropping whatever was left in the work tree
+		self._detach_head()
+		self._update_refs([(i, self._saved_branches[i]) for i in
+				   [self._upstream, self._rebased, self._mainline, self._patches]])
+		self._checkout(self._rebased, '-f')
+
+	def _detach_head(self):
+		# keep the work tree as is while the branches are moved
+		self._git_cmd(['update-ref', '--no-deref', 'HEAD',
+			       self._repo.head.commit.hexsha])
+
+	def _update_refs(self, updates):
+		# a single ref transaction for (branch, new sha) pairs
+		data = ''.join(['update refs/heads/%s %s\n' % (branch, new) for branch, new in updates])
+		self._git_cmd(['update-ref', '--stdin'], data)
+		for branch, new in updates:
+			self._ref_moved(branch, new)
+
+	def _head_is(self, branch):
+		head = self._repo.head
+		return not head.is_detached and head.ref.name == branch
+
+	def _advance(self, branch, commit):
+		# a fast-forward is a plain ref update, anything else is merged in
+		# the work tree
+		old = self._branch_sha(branch)
+		if not self._head_is(branch):
+			if old == commit:
+				return
+			if old in self._commit_info(commit)[1] or self._is_ancestor(old, commit):
+				self._set_branch(branch, commit, old)
+				return
+		self._checkout(branch)
+		self._repo.git.merge(commit)
 
 	def _save_branches(self):
 		git = self._repo.git
-		self._saved_branches[self._upstream] = self._repo.branches[self._upstream].commit.hexsha
-		self._saved_branches[self._rebased] = self._repo.branches[self._rebased].commit.hexsha
-		self._saved_branches[self._mainline] = self._repo.branches[self._mainline].commit.hexsha
-		self._saved_branches[self._patches] = self._repo.branches[self._patches].commit.hexsha
-		self._saved_branches['prev_head'] = self._repo.branches[self._rebased].commit.hexsha
+		self._saved_branches[self._upstream] = self._branch_sha(self._upstream)
+		self._saved_branches[self._rebased] = self._branch_sha(self._rebased)
+		self._saved_branches[self._mainline] = self._branch_sha(self._mainline)
+		self._saved_branches[self._patches] = self._branch_sha(self._patches)
+		self._saved_branches['prev_head'] = self._branch_sha(self._rebased)
 
 	def _get_commits(self, upstream_repo):
-		return [q.hexsha for q in self._repo.iter_commits(self._upstream + '..' + upstream_repo)]
+		# oldest first
+		return CommitList.from_lines(self._git_lines(['rev-list', '--reverse',
+							      self._upstream + '..' + upstream_repo]))
 
-	def _process_commits(self):
+	def _process_commits(self, batch=None):
 		tmp_file = tempfile.TemporaryFile()
+		self._stale = not self._is_ancestor(self._upstream, self._rebased)
+		# branches are moved without checkouts from here on, so none of
+		# them may stay checked out
+		self._detach_head()
 		try:
-			for i in xrange(self._id, len(self._commits)):
-				self._process_commit(self._commits[i], tmp_file)
-				self._id += 1
-				self._cur_num += 1
+			while self._id < len(self._commits):
+				if batch is None or not self._process_batch(batch, tmp_file):
+					self._process_commit(self._commits[self._id], tmp_file)
+					self._id += 1
+					self._cur_num += 1
 				tmp_file.close()
 				tmp_file = tempfile.TemporaryFile()
 		except GitCommandError as e:
@@ -783,63 +1303,277 @@ class GitUpstream(object):
 			self._save_state()
 			raise
 
+	def _process_batch(self, limit, output):
+		# Merge the next commits as one range; if our patches don't rebase
+		# cleanly on top of it, retry with its first half. Returns False
+		# when it comes down to a single commit, which is then processed
+		# the usual way so that conflicts stop there.
+		num = len(self._commits) - self._id
+		if limit > 0:
+			num = min(num, limit)
+		while num > 1:
+			if self._process_range(num, output):
+				self._id += num
+				self._cur_num += num
+				return True
+			num /= 2
+		return False
+
+	def _process_range(self, num, output):
+		commits = self._commits[self._id:self._id + num]
+		self._profile_commit = '%s..%s' % (commits[0], commits[-1])
+		self._log("[%d-%d/%d] Applying %d commits up to: %s" % \
+			  (self._cur_num + 1, self._cur_num + num, self._all_num, num,
+			   self._repo.commit(commits[-1]).summary))
+		upstream_head = self._branch_sha(self._upstream)
+		try:
+			self._stage1(commits[-1])
+			diff = self._stage2(commits[-1], output)
+		except GitCommandError:
+			for cmd in (self._repo.git.rebase, self._repo.git.merge):
+				try:
+					cmd('--abort')
+				except GitCommandError:
+					pass
+			# the aborts leave rebased checked out, but branches are only
+			# moved with a detached HEAD
+			self._detach_head()
+			self._set_branch(self._upstream, upstream_head)
+			self._state = START_ST
+			self._log('Range does not apply cleanly, splitting it.')
+			return False
+		message = 'Merge %d upstream commits up to %s\n\n' % (num, commits[-1])
+		message += '\n'.join([self._repo.commit(c).summary.encode('utf-8') for c in commits])
+		try:
+			self._stage3(commits[-1], diff, message=message)
+		except PatchError:
+			self._id += num - 1
+			raise
+		self._save_repo_state(self._branch_sha(self._mainline) if diff else '')
+		return True
+
 	def _process_commit(self, commit, output):
+		self._profile_commit = commit
 		self._log("[%d/%d] Applying commit: %s" % \
 			  (self._cur_num + 1, self._all_num,
 			   self._repo.commit(commit).summary))
+		upstream_head = self._branch_sha(self._upstream)
 		self._stage1(commit)
-		diff_str = self._stage2(commit, output)
-		self._stage3(commit, diff_str)
-		self._save_repo_state(self._repo.branches[self._mainline].commit.hexsha if diff_str else '')
+		# the last commit always goes through a real rebase, so that the
+		# rebased branch ends up on top of upstream
+		if self._id < len(self._commits) - 1:
+			changes = self._upstream_changes(upstream_head)
+			if not self._touches_patches([i[1] for i in changes]):
+				self._transplant(commit, changes)
+				return
+		diff = self._stage2(commit, output)
+		self._stage3(commit, diff)
+		self._save_repo_state(self._branch_sha(self._mainline) if diff else '')
 
-	def _patch_tree(self, diff_str):
-		status = 0
+	def _is_ancestor(self, c1, c2):
+		try:
+			self._git_cmd(['merge-base', '--is-ancestor', c1, c2])
+		except GitCommandError as e:
+			if e.status == 1:
+				return False
+			raise
+		return True
+
+	def _touched_paths(self):
+		# files touched by our patches and the directories they are in,
+		# recomputed only when rebased moves
+		tip = self._branch_sha(self._rebased)
+		if self._touched_tip != tip:
+			paths = self._git_cmd(['log', '-m', '-z', '--format=', '--name-only', '--no-renames',
+					       '%s..%s' % (self._upstream, tip)]).split('\0')
+			files = set()
+			dirs = set()
+			for i in paths:
+				i = i.strip('\n')
+				if not i:
+					continue
+				files.add(i)
+				i = os.path.dirname(i)
+				while i:
+					dirs.add(i)
+					i = os.path.dirname(i)
+			self._touched = (files, dirs)
+			self._touched_tip = tip
+		return self._touched
+
+	def _touches_patches(self, paths):
+		# a path touches our patches if it is one of our files, replaces a
+		# directory of them or is under one of them replaced by a directory;
+		# other files in the same directories do not
+		files, dirs = self._touched_paths()
+		for i in paths:
+			if i in dirs:
+				return True
+			while i:
+				if i in files:
+					return True
+				i = os.path.dirname(i)
+		return False
+
+	def _upstream_changes(self, prev_upstream):
+		# (raw diff info, path) pairs between the previous and the
+		# current upstream head
+		out = self._git_cmd(['diff-tree', '-r', '-z', '--no-renames', prev_upstream,
+				     self._branch_sha(self._upstream)]).split('\0')
+		return zip(out[0:-1:2], out[1::2])
+
+	@_timed('transplant')
+	def _transplant(self, commit, changes):
+		# An upstream commit that touches none of our patched files can't
+		# conflict: mainline gets the new upstream versions of the changed
+		# files and rebasing our patches is left for the next real rebase.
+		self._state = COMMIT_ST
+		self._stale = True
+		if not changes:
+			self._log('Nothing to commit in branch current, skipping %s commit.' % commit)
+			self._save_repo_state('')
+			return
+		index_info = ''
+		for info, path in changes:
+			mode, sha = info.split()[1], info.split()[3]
+			if mode == '000000':
+				index_info += '0 %s\t%s\0' % ('0' * 40, path)
+			else:
+				index_info += '%s %s\t%s\0' % (mode, sha, path)
+		mainline = self._branch_sha(self._mainline)
 		tmp_dir = tempfile.mkdtemp()
-		with open(tmp_dir + '/__patch__.patch', 'w') as f:
-			f.write(diff_str + '\n')
-		self._repo.git.apply(tmp_dir + '/__patch__.patch')
-		shutil.rmtree(tmp_dir)
+		try:
+			env = {'GIT_INDEX_FILE': tmp_dir + '/index'}
+			self._git_cmd(['read-tree', mainline], env=env)
+			self._git_cmd(['update-index', '-z', '--index-info'], index_info, env)
+			tree = self._git_cmd(['write-tree'], env=env).strip()
+		finally:
+			shutil.rmtree(tmp_dir)
+		c = self._repo.commit(commit)
+		new = self._commit_tree(tree, c.message.encode('utf-8'), [mainline], c.author)
+		self._set_branch(self._mainline, new, mainline)
+		self._save_repo_state(new)
 
+	def _patch_tree(self, diff):
+		# pipe the diff between two commits straight into git apply
+		cwd = self._repo.working_tree_dir
+		start = time.time()
+		producer = Popen(['git', 'diff', '--full-index', diff[0], diff[1]], cwd=cwd,
+				 stdout=PIPE)
+		consumer = Popen(['git', 'apply'], cwd=cwd, stdin=producer.stdout,
+				 stdout=PIPE, stderr=PIPE)
+		producer.stdout.close()
+		out, err = consumer.communicate()
+		producer.wait()
+		# both run at once, so the pipeline is timed as one command
+		self._command_done('diff|apply', start)
+		if producer.returncode != 0:
+			raise GitCommandError(['git', 'diff', diff[0], diff[1]], producer.returncode, '')
+		if consumer.returncode != 0:
+			raise GitCommandError(['git', 'apply'], consumer.returncode, err)
+
+	@_timed('stage1')
 	def _stage1(self, commit):
-		git = self._repo.git
 		self._state = MERGE_ST
-		git.checkout(self._upstream)
-		git.merge(commit)
+		self._advance(self._upstream, commit)
 
+	@_timed('stage2')
 	def _stage2(self, commit, output, rebase_cmd=None, interactive=False):
 		git = self._repo.git
 		self._state = REBASE_ST
 		if rebase_cmd:
 			if interactive:
-				res = call(['git', '--git-dir=' + self._repo.working_dir + '/.git/',
-					    '--work-tree=' + self._repo.working_tree_dir, 'rebase', rebase_cmd], stderr=output)
+				res = self._call(['rebase', rebase_cmd], stderr=output)
 				if res != 0:
 					raise GitCommandError('git rebase %s' % rebase_cmd, res, '')
 			else:
 				git.rebase(rebase_cmd, output_stream=output)
 		else:
-			git.checkout(self._rebased)
-			self._saved_branches['prev_head'] = self._repo.branches[self._rebased].commit.hexsha
-			if interactive:
-				res = call(['git', '--git-dir=' + self._repo.working_dir + '/.git/',
-					    '--work-tree=' + self._repo.working_tree_dir, 'rebase', '-i', commit], stderr=output)
+			# mainline already has the upstream changes that were not
+			# rebased yet, so diff against it in that case
+			prev_head = self._mainline if self._stale else self._rebased
+			self._saved_branches['prev_head'] = self._branch_sha(prev_head)
+			if self._replay and not interactive and self._repo.git.version_info >= (2, 38):
+				self._replay_rebase(commit, output)
+			elif interactive:
+				self._checkout(self._rebased)
+				res = self._call(['rebase', '-i', commit], stderr=output)
 				if res != 0:
 					raise GitCommandError('git rebase', res, '')
 			else:
+				self._checkout(self._rebased)
 				git.rebase(commit, output_stream=output)
-		diff_str = self._repo.git.diff('--full-index', self._saved_branches['prev_head'], self._rebased, stdout_as_string=False)
-		return diff_str
+		self._stale = False
+		# the diff itself is streamed into stage 3, only its ends are
+		# returned here
+		rebased = self._branch_sha(self._rebased)
+		if self._same_tree(self._saved_branches['prev_head'], rebased):
+			return None
+		return (self._saved_branches['prev_head'], rebased)
 
-	def _stage3(self, commit, diff_str, interactive=False, message=''):
+	def _commit_info(self, commit):
+		# parse a raw commit object: (tree, parents, author, date, message)
+		header, message = self._read_object(commit).split('\n\n', 1)
+		tree, parents, author, date = None, [], None, None
+		for i in header.split('\n'):
+			if i.startswith('tree '):
+				tree = i[5:]
+			elif i.startswith('parent '):
+				parents.append(i[7:])
+			elif i.startswith('author '):
+				name, rest = i[7:].split(' <', 1)
+				email, date = rest.split('> ', 1)
+				author = Actor(name.decode('utf-8'), email.decode('utf-8'))
+		return tree, parents, author, date, message
+
+	def _replay_rebase(self, onto, output):
+		# Rebase our patches with tree-level merges instead of git rebase:
+		# nothing is checked out unless a patch conflicts, in which case
+		# git rebase takes over from that patch so that the usual
+		# --continue/--skip/--abort handling applies.
+		stack = self._git_cmd(['rev-list', '--reverse', '--topo-order', '--no-merges',
+				       '%s..%s' % (onto, self._rebased)]).split()
+		old_tip = self._branch_sha(self._rebased)
+		tip = self._repo.commit(onto).hexsha
+		tip_tree = self._commit_info(tip)[0]
+		for c in stack:
+			tree, parents, author, date, message = self._commit_info(c)
+			if parents[0] == tip:
+				tip, tip_tree = c, tree
+				continue
+			# merge-base of the fake base and the patch is its parent,
+			# which makes merge-tree cherry-pick the patch onto tip
+			base = self._commit_tree(tip_tree, 'gitum replay base', [parents[0]])
+			try:
+				new_tree = self._git_cmd(['merge-tree', '--write-tree', base, c]).split()[0]
+			except GitCommandError as e:
+				if e.status != 1:
+					raise
+				self._log('Conflict replaying %s, continuing with git rebase.' % c)
+				self._checkout(self._rebased)
+				self._repo.git.rebase('--onto', tip, parents[0], output_stream=output)
+				return
+			if new_tree == tip_tree and tree != self._commit_info(parents[0])[0]:
+				self._log('Dropping %s: its changes are already upstream.' % c)
+				continue
+			tip = self._commit_tree(new_tree, message, [tip], author, date)
+			tip_tree = new_tree
+		if tip != old_tip:
+			self._set_branch(self._rebased, tip, old_tip)
+
+	@_timed('stage3')
+	def _stage3(self, commit, diff, interactive=False, message=''):
 		git = self._repo.git
 		self._state = COMMIT_ST
-		git.checkout(self._mainline)
-		if diff_str == "":
+		if not diff:
 			self._log('Nothing to commit in branch current, skipping %s commit.' % commit)
 			return
+		if not interactive and self._commit_rebased_tree(commit, diff, message):
+			return
+		self._checkout(self._mainline)
 		git.clean('-d', '-f')
 		try:
-			self._patch_tree(diff_str)
+			self._patch_tree(diff)
 		except:
 			self._id += 1
 			self._state = MERGE_ST
@@ -847,9 +1581,8 @@ class GitUpstream(object):
 					 'Fix error, commit and continue the process, please.' % commit)
 		git.add('-A', self._repo.working_tree_dir)
 		if interactive:
-			res = call(['git', '--git-dir=' + self._repo.working_dir + '/.git/',
-				    '--work-tree=' + self._repo.working_tree_dir, 'commit', '-e', '-m',
-				    'place your comments for %s branch commit' % self._mainline])
+			res = self._call(['commit', '-e', '-m',
+					  'place your comments for %s branch commit' % self._mainline])
 			if res != 0:
 				raise GitCommandError('git commit', res, '')
 		else:
@@ -860,18 +1593,38 @@ class GitUpstream(object):
 			else:
 				git.commit('-m', message)
 
+	def _commit_rebased_tree(self, commit, diff, message):
+		# While mainline has the tree the diff starts from, applying the
+		# diff gives the tree it ends with: commit that one directly
+		# without touching the work tree. Returns False if the trees
+		# have drifted apart and the diff has to be applied.
+		if self._head_is(self._mainline):
+			return False
+		mainline = self._branch_sha(self._mainline)
+		if not self._same_tree(mainline, diff[0]):
+			return False
+		if message:
+			author = None
+		else:
+			c = self._repo.commit(commit)
+			message, author = c.message.encode('utf-8'), c.author
+		new = self._commit_tree(self._tree_id(diff[1]), message, [mainline], author)
+		self._set_branch(self._mainline, new, mainline)
+		return True
+
 	def _save_state(self):
-		with open(self._repo.working_dir + '/' + STATE_FILE, 'w') as f:
-			f.write(self._saved_branches[self._upstream] + '\n')
-			f.write(self._saved_branches[self._rebased] + '\n')
-			f.write(self._saved_branches[self._mainline] + '\n')
-			f.write(self._saved_branches[self._patches] + '\n')
-			f.write(self._saved_branches['prev_head'] + '\n')
-			f.write(str(self._state) + '\n')
-			f.write(str(self._all_num) + '\n')
-			f.write(str(self._cur_num) + '\n')
-			for i in xrange(self._id, len(self._commits)):
-				f.write(str(self._commits[i]) + '\n')
+		if self._repo is not self._main_repo:
+			self._sync_main(detach=False)
+			self._log('Work tree to resolve conflicts in: %s' % self._repo.working_tree_dir)
+		commits = self._commits
+		if not isinstance(commits, CommitList):
+			commits = CommitList(commits)
+		shas = [binascii.unhexlify(self._saved_branches[i]) for i in
+			[self._upstream, self._rebased, self._mainline, self._patches, 'prev_head']]
+		with open(self._main_repo.working_dir + '/' + STATE_FILE, 'wb') as f:
+			f.write(STATE_HEADER.pack(STATE_MAGIC, *(shas + [self._state, self._all_num,
+					  self._cur_num, self._id, len(commits)])))
+			f.write(commits.data())
 
 	def _load_state(self, remove=True):
 		ret = True
@@ -883,8 +1636,38 @@ class GitUpstream(object):
 		return ret
 
 	def _load_state_raised(self, remove):
-		with open(self._repo.working_dir + '/' + STATE_FILE, 'r') as f:
-			strs = [q.split()[0] for q in f.readlines() if len(q.split()) > 0]
+		with open(self._main_repo.working_dir + '/' + STATE_FILE, 'rb') as f:
+			if f.read(len(STATE_MAGIC)) == STATE_MAGIC:
+				f.seek(0)
+				self._load_binary_state(f)
+			else:
+				f.seek(0)
+				self._load_text_state(f)
+		if remove:
+			os.unlink(self._main_repo.working_dir + '/' + STATE_FILE)
+
+	def _load_binary_state(self, f):
+		header = f.read(STATE_HEADER.size)
+		if len(header) != STATE_HEADER.size:
+			raise IOError
+		fields = STATE_HEADER.unpack(header)
+		shas = [binascii.hexlify(i) for i in fields[1:6]]
+		self._saved_branches[self._upstream] = shas[0]
+		self._saved_branches[self._rebased] = shas[1]
+		self._saved_branches[self._mainline] = shas[2]
+		self._saved_branches[self._patches] = shas[3]
+		self._saved_branches['prev_head'] = shas[4]
+		self._state, self._all_num, self._cur_num, pos, num = fields[6:]
+		# only the commits left are read
+		f.seek(STATE_HEADER.size + pos * SHA_SIZE)
+		data = f.read((num - pos) * SHA_SIZE)
+		if len(data) != (num - pos) * SHA_SIZE:
+			raise IOError
+		self._commits = CommitList(data=data)
+
+	def _load_text_state(self, f):
+		# the state file of older versions
+		strs = [q.split()[0] for q in f.readlines() if len(q.split()) > 0]
 		if len(strs) < 6:
 			raise IOError
 		self._saved_branches[self._upstream] = strs[0]
@@ -897,8 +1680,6 @@ class GitUpstream(object):
 		self._cur_num = int(strs[7])
 		for i in xrange(8, len(strs)):
 			self._commits.append(strs[i])
-		if remove:
-			os.unlink(self._repo.working_dir + '/' + STATE_FILE)
 
 	def _log_error(self, mess):
 		if self._with_log and mess:
@@ -919,10 +1700,10 @@ class GitUpstream(object):
 		self._all_num = 0
 		self._commits = []
 		self._saved_branches = {}
-
-	def _apply_patch_am(self, directory, patch, **kwargs):
-		self._log('Applying patch: ' + patch)
-		self._repo.git.am(directory + '/' + patch, **kwargs)
+		self._stale = False
+		self._replay = False
+		self._touched = None
+		self._touched_tip = None
 
 	def _diffapply(self, diff, message):
 		try:
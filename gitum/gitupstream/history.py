@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import bisect
+
+class HistoryEntry(object):
+	def __init__(self, commit, parent, root, position, upstream, mainline, date, patch_ids):
+		self.commit = commit
+		self.parent = parent
+		self.root = root
+		self.position = position
+		self.upstream = upstream
+		self.mainline = mainline
+		self.date = date
+		self.patch_ids = patch_ids
+
+	def line(self):
+		return '%s %s %s %d %s %s %d %s\n' % (self.commit, self.parent or '-', self.root,
+						    self.position, self.upstream, self.mainline or '-',
+						    self.date, ','.join(self.patch_ids) or '-')
+
+	@staticmethod
+	def parse(line):
+		parts = line.split()
+		if len(parts) != 8:
+			return None
+		ids = parts[7].split(',') if parts[7] != '-' else []
+		return HistoryEntry(parts[0], parts[1] if parts[1] != '-' else None, parts[2],
+				    int(parts[3]), parts[4], parts[5] if parts[5] != '-' else None,
+				    int(parts[6]), ids)
+
+# Append-only on-disk index of patches branch commits: every commit is
+# mapped to its parent, the root of its patches branch, its position from
+# that root, the upstream and mainline commits it was saved for, its date
+# and the patch-ids of the saved patch stack.
+class PatchesHistory(object):
+	def __init__(self, path):
+		self._path = path
+		self._load()
+
+	def _load(self):
+		self._entries = {}
+		self._order = []
+		self._by_upstream = {}
+		self._by_mainline = {}
+		self._dates = []
+		try:
+			with open(self._path) as f:
+				for i in f:
+					entry = HistoryEntry.parse(i)
+					if entry:
+						self._index(entry)
+		except IOError:
+			pass
+
+	def _index(self, entry):
+		self._entries[entry.commit] = entry
+		self._order.append(entry.commit)
+		# later states win for upstream and mainline lookups
+		self._by_upstream[entry.upstream] = entry
+		if entry.mainline:
+			self._by_mainline[entry.mainline] = entry
+		# entries of the same second keep the order they were recorded in
+		bisect.insort(self._dates, (entry.date, len(self._order), entry.commit))
+
+	def add(self, commit, parent, root, position, upstream, mainline, date, patch_ids=[]):
+		if commit in self._entries:
+			return self._entries[commit]
+		entry = HistoryEntry(commit, parent, root, position, upstream, mainline,
+				     date, patch_ids)
+		with open(self._path, 'a') as f:
+			f.write(entry.line())
+		self._index(entry)
+		return entry
+
+	def get(self, commit):
+		return self._entries.get(commit)
+
+	def by_upstream(self, commit):
+		return self._by_upstream.get(commit)
+
+	def by_mainline(self, commit):
+		return self._by_mainline.get(commit)
+
+	# entries saved at or before date, the latest first
+	def before_date(self, date):
+		pos = bisect.bisect_right(self._dates, (date, float('inf')))
+		for i in xrange(pos - 1, -1, -1):
+			yield self._entries[self._dates[i][2]]
+
+	# the latest commit both commit1 and commit2 come from or None if it
+	# is not known from indexed entries
+	def common(self, commit1, commit2):
+		entry1 = self._entries.get(commit1)
+		entry2 = self._entries.get(commit2)
+		if not entry1 or not entry2 or entry1.root != entry2.root:
+			return None
+		while entry1 and entry2 and entry1.commit != entry2.commit:
+			if entry1.position >= entry2.position:
+				entry1 = self._entries.get(entry1.parent)
+			else:
+				entry2 = self._entries.get(entry2.parent)
+		return entry1.commit if entry1 and entry2 else None
+
+	# commits from stop (exclusive, the root if not given) to commit or
+	# None if stop is not reachable through indexed entries
+	def chain(self, commit, stop=None):
+		res = []
+		entry = self._entries.get(commit)
+		limit = self._entries.get(stop) if stop else None
+		if stop and (not limit or not entry or limit.root != entry.root):
+			return None
+		while entry:
+			if stop and entry.commit == stop:
+				res.reverse()
+				return res
+			if limit and entry.position <= limit.position:
+				return None
+			res.append(entry.commit)
+			if not entry.parent:
+				break
+			entry = self._entries.get(entry.parent)
+		if stop or not res or self._entries[res[-1]].position != 0:
+			return None
+		res.reverse()
+		return res
+
+	# forget the entries recorded on top of commit (e.g. on abort); a
+	# parent is always recorded before its children
+	def truncate(self, commit):
+		drop = set()
+		for i in self._order:
+			if self._entries[i].parent == commit or self._entries[i].parent in drop:
+				drop.add(i)
+		if not drop:
+			return
+		with open(self._path, 'w') as f:
+			for i in self._order:
+				if i not in drop:
+					f.write(self._entries[i].line())
+		self._load()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import time
+from contextlib import contextmanager
+from gitcmd import subcommand, hooked
+
+def _add(stats, name, elapsed, nbytes):
+	stat = stats.setdefault(name, {'count': 0, 'time': 0.0, 'bytes': 0})
+	stat['count'] += 1
+	stat['time'] += elapsed
+	stat['bytes'] += nbytes
+
+# Collects wall time of merge stages per upstream commit and the number,
+# duration and output size of the git commands that were run, in total and
+# per (innermost) stage they were run in.
+class Profiler(object):
+	def __init__(self):
+		self.start = time.time()
+		self.stages = []
+		self.commands = {}
+		self.stage_commands = {}
+		self._active = []
+
+	@contextmanager
+	def stage(self, name, commit):
+		start = time.time()
+		self._active.append(name)
+		try:
+			yield
+		finally:
+			self._active.pop()
+			self.stages.append((commit, name, time.time() - start))
+
+	def command(self, name, elapsed, nbytes=0):
+		_add(self.commands, name, elapsed, nbytes)
+		if self._active:
+			_add(self.stage_commands.setdefault(self._active[-1], {}), name, elapsed, nbytes)
+
+	def watch(self, repo):
+		# account every command run through the GitPython object of repo,
+		# including requests served by its persistent cat-file processes
+		git = hooked(repo)
+		git.hooks.append(self._executed)
+		git.object_hooks.append(self.command)
+
+	def _executed(self, command, elapsed, res):
+		nbytes = len(res) if isinstance(res, basestring) else 0
+		self.command(subcommand(command), elapsed, nbytes)
+
+	def report(self):
+		totals = {}
+		for commit, name, elapsed in self.stages:
+			totals[name] = totals.get(name, 0.0) + elapsed
+		return {
+			'total_time': time.time() - self.start,
+			'stages': [{'commit': commit, 'stage': name, 'time': elapsed}
+				   for commit, name, elapsed in self.stages],
+			'stage_totals': totals,
+			'git': self.commands,
+			'stage_git': self.stage_commands,
+		}
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import os
+from errors import NotSupported
+
+# Reads branches straight from the files of a repository for quick commands
+# that should answer without starting git or importing GitPython.
+
+def read_ref(git_dir, branch):
+	# sha of the branch or None if it does not exist: a loose ref file
+	# takes precedence over packed-refs, other ref storages are not supported
+	if os.path.exists(git_dir + '/reftable'):
+		raise NotSupported(git_dir)
+	ref = 'refs/heads/' + branch
+	try:
+		with open(git_dir + '/' + ref) as f:
+			sha = f.readline().strip()
+		if sha.startswith('ref:'):
+			raise NotSupported(ref)
+		return sha
+	except IOError:
+		pass
+	try:
+		with open(git_dir + '/packed-refs') as f:
+			for line in f:
+				if line.startswith('#') or line.startswith('^'):
+					continue
+				parts = line.split()
+				if len(parts) == 2 and parts[1] == ref:
+					return parts[0]
+	except IOError:
+		pass
+	return None
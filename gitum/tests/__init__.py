@@ -20,7 +20,9 @@
 
 import unittest
 import gitumtest
+import budgettest
 
 local_tests = unittest.TestLoader().loadTestsFromTestCase(gitumtest.LocalWorkTest)
 remote_tests = unittest.TestLoader().loadTestsFromTestCase(gitumtest.RemoteWorkTest)
-test_all = unittest.TestSuite([local_tests, remote_tests])
+budget_tests = unittest.TestLoader().loadTestsFromTestCase(budgettest.SubprocessBudgetTest)
+test_all = unittest.TestSuite([local_tests, remote_tests, budget_tests])
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Times gitum operations on generated repositories:
+#
+#   python tests/benchmark.py -n 200 -m 20 --files 500 --conflicts 0.05 -o new.json
+#   python tests/benchmark.py -n 200 -m 20 --files 500 --conflicts 0.05 --compare old.json
+#
+# Local patches change the first lines of the files, upstream commits change
+# the last ones unless they are chosen to conflict with a local patch.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git
+from gitupstream import *
+
+_FILE_LINES = 40
+_LOCAL_LINES = 10
+_UPSTREAM_LINE = 20
+
+OPERATIONS = ['update', 'merge', 'continue_merge', 'restore', 'restore_rebased',
+	      'push', 'clone', 'pull']
+
+def _log(string):
+	sys.stderr.write(string + '\n')
+
+def _file_name(num):
+	return 'dir%d/file%d' % (num % 16, num)
+
+def _set_line(path, line, text):
+	with open(path) as f:
+		lines = f.readlines()
+	lines[line] = text + '\n'
+	with open(path, 'w') as f:
+		f.writelines(lines)
+
+def _commit(repo, path, message):
+	repo.git.add(path)
+	repo.git.commit('-q', '-m', message)
+
+class Timer(object):
+	def __init__(self):
+		self.results = {}
+
+	def run(self, name, func, *args, **kwargs):
+		start = time.time()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			self.add(name, time.time() - start)
+
+	def add(self, name, elapsed):
+		self.results[name] = self.results.get(name, 0.0) + elapsed
+
+class Benchmark(object):
+	def __init__(self, args):
+		self.args = args
+		self.random = random.Random(args.seed)
+		self.conflicts = 0
+
+	def _new_repo(self, path, user):
+		gitum_repo = GitUpstream(repo_path=path, new_repo=True)
+		gitum_repo.repo().git.config('user.name', user)
+		gitum_repo.repo().git.config('user.email', user + '@localhost')
+		return gitum_repo
+
+	def _generate(self, path):
+		gitum_repo = self._new_repo(path, 'bench')
+		repo = gitum_repo.repo()
+		for i in xrange(self.args.files):
+			name = path + '/' + _file_name(i)
+			if not os.path.exists(os.path.dirname(name)):
+				os.makedirs(os.path.dirname(name))
+			with open(name, 'w') as f:
+				f.writelines(['%s line %d\n' % (_file_name(i), j) for j in xrange(_FILE_LINES)])
+		repo.git.add('.')
+		repo.git.commit('-q', '-m', 'initial')
+		repo.create_head('upstream')
+		gitum_repo.create('upstream', 'master', 'rebased', 'mainline', 'patches')
+		return gitum_repo
+
+	def _local_patch(self, num):
+		# the file and the line changed by the num-th local patch
+		return (num % self.args.files, (num // self.args.files) % _LOCAL_LINES)
+
+	def _add_local_patches(self, gitum_repo, start, count):
+		repo = gitum_repo.repo()
+		repo.git.checkout('rebased')
+		for i in xrange(start, start + count):
+			num, line = self._local_patch(i)
+			path = repo.working_dir + '/' + _file_name(num)
+			_set_line(path, line, 'local %d' % i)
+			_commit(repo, path, 'local: %d' % i)
+
+	def _add_upstream_commits(self, gitum_repo):
+		repo = gitum_repo.repo()
+		repo.git.checkout('upstream')
+		for i in xrange(self.args.upstream):
+			if self.args.patches and self.random.random() < self.args.conflicts:
+				num, line = self._local_patch(self.random.randrange(self.args.patches))
+			else:
+				num = self.random.randrange(self.args.files)
+				line = _UPSTREAM_LINE + self.random.randrange(_FILE_LINES - _UPSTREAM_LINE)
+			path = repo.working_dir + '/' + _file_name(num)
+			_set_line(path, line, 'upstream %d' % i)
+			_commit(repo, path, 'upstream: %d' % i)
+		repo.git.checkout('rebased')
+
+	def _resolve(self, gitum_repo):
+		# keep the version of the local patch being rebased
+		repo = gitum_repo.repo()
+		for i in repo.git.diff('--name-only', '--diff-filter=U').splitlines():
+			repo.git.checkout('--theirs', '--', i)
+			repo.git.add(i)
+		self.conflicts += 1
+
+	def _merge(self, gitum_repo, timer):
+		kwargs = {'batch': self.args.batch, 'replay': self.args.replay}
+		try:
+			timer.run('merge', gitum_repo.merge, 'upstream', **kwargs)
+			return
+		except RebaseFailed:
+			pass
+		while True:
+			self._resolve(gitum_repo)
+			try:
+				timer.run('continue_merge', gitum_repo.continue_merge, '--continue', **kwargs)
+				return
+			except RebaseFailed:
+				pass
+
+	def run_once(self, workdir):
+		timer = Timer()
+		origin = workdir + '/origin'
+		bare = workdir + '/bare.git'
+		clone = workdir + '/clone'
+		for i in [origin, bare, clone]:
+			os.makedirs(i)
+
+		_log('generating %d files, %d local patches...' % (self.args.files, self.args.patches))
+		gitum_repo = self._generate(origin)
+		self._add_local_patches(gitum_repo, 0, self.args.patches)
+		timer.run('update', gitum_repo.update)
+
+		_log('generating %d upstream commits...' % self.args.upstream)
+		self._add_upstream_commits(gitum_repo)
+		self._merge(gitum_repo, timer)
+		timer.add('continue_merge', 0.0)
+
+		timer.run('restore', gitum_repo.restore)
+		timer.run('restore_rebased', gitum_repo.restore, rebased_only=True)
+
+		git.Repo.init(bare, bare=True)
+		gitum_repo.repo().git.remote('add', 'bench', bare)
+		timer.run('push', gitum_repo.push, 'bench')
+
+		cloned = self._new_repo(clone, 'bench2')
+		timer.run('clone', cloned.clone, bare)
+
+		# new patches on both sides: ours are replayed on top of the pushed ones
+		pulled = max(self.args.patches // 2, 1)
+		self._add_local_patches(gitum_repo, self.args.patches, pulled)
+		gitum_repo.update()
+		gitum_repo.push('bench')
+		self._add_local_patches(cloned, self.args.patches + pulled, pulled)
+		cloned.update()
+		timer.run('pull', cloned.pull, 'origin')
+		return timer.results
+
+	def run(self):
+		runs = []
+		for i in xrange(self.args.repeat):
+			workdir = tempfile.mkdtemp()
+			try:
+				runs.append(self.run_once(workdir))
+			finally:
+				if not self.args.keep:
+					shutil.rmtree(workdir)
+				else:
+					_log('workdir: %s' % workdir)
+		results = {}
+		for op in OPERATIONS:
+			times = [i[op] for i in runs if op in i]
+			if times:
+				results[op] = {'best': min(times), 'runs': times}
+		return {
+			'params': {
+				'upstream': self.args.upstream,
+				'patches': self.args.patches,
+				'files': self.args.files,
+				'conflicts': self.args.conflicts,
+				'seed': self.args.seed,
+				'batch': self.args.batch,
+				'replay': self.args.replay,
+			},
+			'git_version': git.Git().version(),
+			'date': int(time.time()),
+			'conflicts': self.conflicts // self.args.repeat,
+			'results': results,
+		}
+
+def compare(report, baseline):
+	# ratio of the best times, > 1 means slower than the baseline
+	res = {}
+	print('%-16s %10s %10s %8s' % ('operation', 'baseline', 'current', 'ratio'))
+	for op in OPERATIONS:
+		if op not in report['results'] or op not in baseline['results']:
+			continue
+		old = baseline['results'][op]['best']
+		new = report['results'][op]['best']
+		res[op] = new / old if old else 1.0
+		print('%-16s %10.3f %10.3f %8.2f' % (op, old, new, res[op]))
+	if report['params'] != baseline['params']:
+		print('warning: the baseline was measured with different parameters')
+	return res
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark gitum operations on generated repos.')
+	parser.add_argument('-n', '--upstream', type=int, default=100,
+		help='number of upstream commits to merge')
+	parser.add_argument('-m', '--patches', type=int, default=10,
+		help='number of local patches')
+	parser.add_argument('--files', type=int, default=100,
+		help='number of files in the tree')
+	parser.add_argument('--conflicts', type=float, default=0.0,
+		help='share of upstream commits that conflict with a local patch')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=1,
+		help='run every operation this many times and keep the best time')
+	parser.add_argument('--batch', nargs='?', const=0, type=int, default=None,
+		help='merge with --batch')
+	parser.add_argument('--replay', action='store_true',
+		help='merge with --replay')
+	parser.add_argument('-o', '--output', metavar='file',
+		help='write the JSON results to a file instead of stdout')
+	parser.add_argument('--compare', metavar='file',
+		help='compare the results with a previous JSON report')
+	parser.add_argument('--max-slowdown', type=float, default=None,
+		help='exit with an error if an operation is slower than the baseline by this ratio')
+	parser.add_argument('--keep', action='store_true',
+		help='do not remove generated repos')
+	args = parser.parse_args()
+	if args.files < 1 or args.repeat < 1:
+		parser.error('--files and --repeat must be positive')
+
+	report = Benchmark(args).run()
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+	elif not args.compare:
+		json.dump(report, sys.stdout, indent=1, sort_keys=True)
+		print('')
+	if args.compare:
+		with open(args.compare) as f:
+			ratios = compare(report, json.load(f))
+		if args.max_slowdown and [i for i in ratios.values() if i > args.max_slowdown]:
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
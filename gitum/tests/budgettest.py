@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gitum - Git Upstream Manager.
+# Copyright (C) 2012  Pavel Shilovsky <piastry@etersoft.ru>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import git
+from gitupstream import *
+from gitupstream.gitcmd import hooked
+import os
+import sys
+import shutil
+import unittest
+import tempfile
+
+# set to True for debugging
+_WITH_LOG = False
+_NO_REMOVE = False
+
+# git processes started per upstream commit by a merge that does not touch
+# the patch stack and by the merge setup and the last (rebased) commit
+_UNTOUCHED_PER_COMMIT = 14
+_MERGE_OVERHEAD = 40
+# git processes started per local commit by update
+_UPDATE_PER_COMMIT = 14
+
+def _log(string):
+	if _WITH_LOG:
+		sys.stderr.write(string + '\n')
+
+def _command(command):
+	if isinstance(command, basestring):
+		command = command.split()
+	return [str(i) for i in command]
+
+# Records every git process started by a GitUpstream object: the ones run
+# through its GitPython object (hooked after they finish) and the ones
+# gitupstream starts with Popen and call.
+class Subprocesses(object):
+	def __init__(self):
+		self.commands = []
+		self._module = sys.modules[GitUpstream.__module__]
+		self._saved = {}
+
+	def install(self, gitum_repo):
+		hooked(gitum_repo.repo()).hooks.append(self._executed)
+		for name in ['Popen', 'call']:
+			self._saved[name] = getattr(self._module, name)
+			setattr(self._module, name, self._wrap(self._saved[name]))
+
+	def _executed(self, command, elapsed, res):
+		self.commands.append(_command(command))
+
+	def uninstall(self):
+		for name, func in self._saved.items():
+			setattr(self._module, name, func)
+		self._saved = {}
+
+	def _wrap(self, func):
+		def counted(args, *rest, **kwargs):
+			self.commands.append(_command(args))
+			return func(args, *rest, **kwargs)
+		return counted
+
+	def reset(self):
+		self.commands = []
+
+	def count(self, subcommand=None):
+		return len([i for i in self.commands
+			    if not subcommand or subcommand in i[1:2]])
+
+	def checkouts(self, branch=None):
+		# any command that changes the checked out work tree of a branch
+		res = []
+		for i in self.commands:
+			if i[1:2] != ['checkout']:
+				continue
+			if not branch or branch in i[2:]:
+				res.append(i)
+		return res
+
+class SubprocessBudgetTest(unittest.TestCase):
+	def setUp(self):
+		self.dirname = tempfile.mkdtemp()
+		self.counter = Subprocesses()
+
+	def tearDown(self):
+		self.counter.uninstall()
+		if not _NO_REMOVE:
+			shutil.rmtree(self.dirname)
+		else:
+			_log('dirname: %s' % self.dirname)
+
+	def _create(self, patches):
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		for i in xrange(patches):
+			with open(self.dirname + '/testfile', 'a') as f:
+				f.write('%d' % i)
+			gitum_repo.repo().git.add(self.dirname + '/testfile')
+			gitum_repo.repo().git.commit('-m', 'local: %d' % i)
+		return gitum_repo
+
+	def _upstream_commits(self, gitum_repo, num):
+		gitum_repo.repo().git.checkout('merge')
+		for i in xrange(num):
+			with open(self.dirname + '/otherfile', 'a') as f:
+				f.write('%d\n' % i)
+			gitum_repo.repo().git.add(self.dirname + '/otherfile')
+			gitum_repo.repo().git.commit('-m', 'remote: %d' % i)
+		gitum_repo.repo().git.checkout('rebased')
+
+	def _counted(self, gitum_repo):
+		# a fresh object as the command line tool would use
+		res = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG)
+		self.counter.install(res)
+		return res
+
+	def test_untouched_merge(self):
+		_log('UntouchedMergeBudget test has started!')
+		gitum_repo = self._create(2)
+		gitum_repo.update()
+		num = 12
+		self._upstream_commits(gitum_repo, num)
+
+		_log('doing gitum merge...')
+		counted = self._counted(gitum_repo)
+		counted.merge()
+		_log('%d git processes, %d checkouts' % (self.counter.count(),
+							  len(self.counter.checkouts())))
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(self.counter.checkouts('patches'), [])
+		self.assertTrue(self.counter.count() <= _UNTOUCHED_PER_COMMIT * num + _MERGE_OVERHEAD)
+		# upstream is fast-forwarded without checkouts
+		self.assertTrue(len(self.counter.checkouts()) <= 2)
+		self.assertEqual(self.counter.count('rebase'), 1)
+		# the rebased tree is committed onto mainline as is
+		self.assertEqual(self.counter.count('apply'), 0)
+		self.assertEqual(self.counter.count('commit'), 0)
+		_log('OK')
+
+		_log('UntouchedMergeBudget test has finished!')
+
+	def test_update(self):
+		_log('UpdateBudget test has started!')
+		num = 8
+		gitum_repo = self._create(num)
+
+		_log('doing gitum update...')
+		counted = self._counted(gitum_repo)
+		counted.update()
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(self.counter.checkouts('patches'), [])
+		self.assertEqual(self.counter.count('cherry-pick'), num)
+		self.assertTrue(self.counter.count() <= _UPDATE_PER_COMMIT * num + 10)
+		_log('OK')
+
+		_log('UpdateBudget test has finished!')
+
+	def test_restore(self):
+		_log('RestoreBudget test has started!')
+		gitum_repo = self._create(8)
+		gitum_repo.update()
+
+		_log('doing gitum restore...')
+		rebased = gitum_repo.repo().branches['rebased'].commit.hexsha
+		counted = self._counted(gitum_repo)
+		counted.restore()
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(self.counter.checkouts('patches'), [])
+		# one am for the mainline, the saved rebased branch is reused
+		self.assertEqual(self.counter.count('am'), 1)
+		self.assertEqual(gitum_repo.repo().branches['rebased'].commit.hexsha, rebased)
+		self.assertTrue(self.counter.count() <= 30)
+
+		os.unlink(self.dirname + '/.git/.gitum-rebased-cache')
+		self.counter.reset()
+		counted.restore(rebased_only=True)
+		self.assertEqual(self.counter.count('am'), 1)
+		self.assertTrue(self.counter.count() <= 15)
+
+		rebased = gitum_repo.repo().branches['rebased'].commit.hexsha
+		self.counter.reset()
+		counted.restore(rebased_only=True)
+		self.assertEqual(self.counter.count('am'), 0)
+		self.assertEqual(gitum_repo.repo().branches['rebased'].commit.hexsha, rebased)
+		_log('OK')
+
+		_log('RestoreBudget test has finished!')
+
+	def test_pull(self):
+		_log('PullBudget test has started!')
+		gitum_repo = self._create(1)
+		gitum_repo.update()
+		clonedir = tempfile.mkdtemp()
+		try:
+			self._pull(gitum_repo, clonedir)
+		finally:
+			shutil.rmtree(clonedir)
+		_log('PullBudget test has finished!')
+
+	def _pull(self, gitum_repo, clonedir):
+		_log('cloning the repo...')
+		cloned = GitUpstream(repo_path=clonedir, with_log=_WITH_LOG, new_repo=True)
+		cloned.repo().git.config('user.name', '"tester2"')
+		cloned.repo().git.config('user.email', '"tester2@localhost"')
+		cloned.clone(self.dirname)
+		num = 6
+		for i in xrange(num):
+			with open(clonedir + '/clonefile', 'a') as f:
+				f.write('%d\n' % i)
+			cloned.repo().git.add(clonedir + '/clonefile')
+			cloned.repo().git.commit('-m', 'clone: %d' % i)
+		cloned.update()
+		_log('OK')
+
+		_log('making changes on the remote side...')
+		with open(self.dirname + '/testfile', 'a') as f:
+			f.write('r')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: r')
+		gitum_repo.update()
+		_log('OK')
+
+		_log('doing gitum pull...')
+		counted = GitUpstream(repo_path=clonedir, with_log=_WITH_LOG)
+		self.counter.install(counted)
+		counted.pull('origin')
+		self.assertEqual(cloned.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(len(cloned.repo().git.rev_list('origin/dev..dev').split()), num)
+		# our commits are applied with one am and one cherry-pick
+		self.assertEqual(self.counter.count('am'), 2)
+		self.assertEqual(self.counter.count('cherry-pick'), 1)
+		self.assertEqual(self.counter.count('reset'), 0)
+		self.assertTrue(self.counter.count() <= 40)
+		_log('OK')
+
+	def test_fast_forward_pull(self):
+		_log('FastForwardPullBudget test has started!')
+		gitum_repo = self._create(2)
+		gitum_repo.update()
+		clonedir = tempfile.mkdtemp()
+		try:
+			self._fast_forward_pull(gitum_repo, clonedir)
+		finally:
+			shutil.rmtree(clonedir)
+		_log('FastForwardPullBudget test has finished!')
+
+	def _fast_forward_pull(self, gitum_repo, clonedir):
+		_log('cloning the repo...')
+		cloned = GitUpstream(repo_path=clonedir, with_log=_WITH_LOG, new_repo=True)
+		cloned.repo().git.config('user.name', '"tester2"')
+		cloned.repo().git.config('user.email', '"tester2@localhost"')
+		cloned.clone(self.dirname)
+		rebased = cloned.repo().branches['rebased'].commit.hexsha
+		with open(self.dirname + '/testfile', 'a') as f:
+			f.write('r')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: r')
+		gitum_repo.update()
+		_log('OK')
+
+		_log('doing gitum pull...')
+		counted = GitUpstream(repo_path=clonedir, with_log=_WITH_LOG)
+		self.counter.install(counted)
+		counted.pull('origin')
+		for i in ['master', 'dev', 'patches']:
+			self.assertEqual(cloned.repo().branches[i].commit.hexsha,
+					 gitum_repo.repo().branches[i].commit.hexsha)
+		self.assertEqual(cloned.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(cloned.repo().head.ref.name, 'rebased')
+		# only the new patch is applied on top of the rebased branch
+		# built before, nothing is replayed
+		self.assertEqual(cloned.repo().commit('rebased~').hexsha, rebased)
+		self.assertEqual(self.counter.count('am'), 1)
+		self.assertEqual(self.counter.count('cherry-pick'), 0)
+		self.assertEqual(self.counter.count('reset'), 0)
+		_log('OK')
+
+		_log('doing gitum pull without changes...')
+		rebased = cloned.repo().branches['rebased'].commit.hexsha
+		self.counter.reset()
+		counted.pull('origin')
+		self.assertEqual(cloned.repo().branches['rebased'].commit.hexsha, rebased)
+		self.assertEqual(self.counter.count('am'), 0)
+		self.assertTrue(self.counter.count() <= 12)
+		_log('OK')
+
+if __name__ == "__main__":
+	unittest.main()
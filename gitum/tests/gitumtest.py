@@ -20,11 +20,18 @@
 
 import git
 from gitupstream import *
+from gitupstream.gitupstream import STATE_MAGIC, STATE_HEADER
+from gitupstream.daemon import DAEMON_CONN_TIMEOUT
 import os
 import sys
+import binascii
+import time
 import shutil
 import unittest
 import tempfile
+import socket
+import threading
+from subprocess import Popen, PIPE
 
 # set to True for debugging
 _WITH_LOG = False
@@ -120,6 +127,8 @@ class LocalWorkTest(unittest.TestCase):
 		gitum_repo.update()
 		_log('OK')
 
+		mainline_d = gitum_repo.repo().git.rev_parse('dev~')
+
 		_log('restore gitum repo to the state 2 changes before...')
 		gitum_repo.restore(commit='patches^')
 		with open(self.dirname + '/testfile', 'r') as f:
@@ -128,6 +137,15 @@ class LocalWorkTest(unittest.TestCase):
 		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
 		_log('OK')
 
+		_log('restore gitum repo to the state saved for a mainline commit...')
+		gitum_repo.restore()
+		gitum_repo.restore(commit=mainline_d)
+		with open(self.dirname + '/testfile', 'r') as f:
+			data = f.read(4)
+		self.assertEqual(data, 'acd')
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		_log('OK')
+
 		_log('restore gitum repo to the initial state...')
 		gitum_repo.restore(commit='patches^^^')
 		with open(self.dirname + '/testfile', 'r') as f:
@@ -138,6 +156,136 @@ class LocalWorkTest(unittest.TestCase):
 
 		_log('Restore test has finished!')
 
+	def test_abort_restore(self):
+		_log('AbortRestore test has started!')
+
+		_log('creating git repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('ab\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: b')
+		gitum_repo.update()
+		patches = gitum_repo.repo().branches['patches'].commit.hexsha
+		_log('OK')
+
+		_log('checking patch-ids of the saved stack...')
+		show = gitum_repo.repo().git.show('rebased') + '\n'
+		patch_id = Popen(['git', 'patch-id', '--stable'], cwd=self.dirname, stdin=PIPE,
+				 stdout=PIPE).communicate(show)[0].split()[0]
+		with open(self.dirname + '/.git/.gitum-history') as f:
+			entry = [i.split() for i in f if i.startswith(patches)][0]
+		self.assertEqual(entry[7], patch_id)
+		_log('OK')
+
+		_log('aborting gitum merge...')
+		gitum_repo.repo().git.checkout('merge')
+		for i in xrange(2):
+			with open(self.dirname + '/otherfile', 'a') as f:
+				f.write('%d\n' % i)
+			gitum_repo.repo().git.add(self.dirname + '/otherfile')
+			gitum_repo.repo().git.commit('-m', 'remote: %d' % i)
+		merged = gitum_repo.repo().branches['merge'].commit.hexsha
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('s\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'remote: s')
+		gitum_repo.repo().git.checkout('rebased')
+		self.assertRaises(GitUmException, gitum_repo.merge)
+		gitum_repo.abort()
+		self.assertEqual(gitum_repo.repo().branches['patches'].commit.hexsha, patches)
+		# nothing saved by the aborted merge is left in the history index
+		with open(self.dirname + '/.git/.gitum-history') as f:
+			for i in f:
+				gitum_repo.repo().git.merge_base('--is-ancestor', i.split()[0], patches)
+		_log('OK')
+
+		_log('restoring to states of the aborted merge...')
+		self.assertRaises(GitUmException, gitum_repo.restore, merged)
+		self.assertEqual(gitum_repo.repo().branches['patches'].commit.hexsha, patches)
+		_log('OK')
+
+		_log('restoring to a date...')
+		gitum_repo.restore(date='now')
+		self.assertEqual(gitum_repo.repo().branches['patches'].commit.hexsha, patches)
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(gitum_repo.repo().git.show('dev:testfile'), 'ab\n\n\n\n\nz')
+		self.assertRaises(GitUmException, gitum_repo.restore, date='1980-01-01')
+		_log('OK')
+
+		_log('AbortRestore test has finished!')
+
+	def test_status(self):
+		_log('Status test has started!')
+
+		_log('creating git repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		self.assertEqual(gitum_repo.status(), STATUS_CLEAN)
+		_log('OK')
+
+		_log('checking status of new commits...')
+		with open(self.dirname + '/testfile', 'a') as f:
+			f.write('b')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: b')
+		self.assertEqual(gitum_repo.status(), STATUS_LOCAL_CHANGES)
+		gitum_repo.update()
+		self.assertEqual(gitum_repo.status(), STATUS_CLEAN)
+		gitum_repo.repo().git.commit('--allow-empty', '-m', 'local: empty')
+		self.assertEqual(gitum_repo.status(), STATUS_NEW_COMMITS)
+		# the cached result is used while the branches stay the same
+		with open(self.dirname + '/.git/.gitum-status') as f:
+			self.assertEqual(f.read().split('\n')[1:3], [STATUS_NEW_COMMITS, 'local: empty'])
+		self.assertEqual(gitum_repo.status(), STATUS_NEW_COMMITS)
+		_log('OK')
+
+		_log('checking quick status...')
+		self.assertEqual(quick_status(self.dirname), STATUS_NEW_COMMITS)
+		# the config is cached for the sha of the config branch
+		with open(self.dirname + '/.git/.gitum-config-cache') as f:
+			self.assertEqual(f.read().split('\n')[:2],
+					 [gitum_repo.repo().branches['gitum-config'].commit.hexsha,
+					  'master rebased dev patches'])
+		gitum_repo.repo().git.pack_refs('--all')
+		self.assertEqual(quick_status(self.dirname), STATUS_NEW_COMMITS)
+		gitum_repo.repo().git.commit('--allow-empty', '-m', 'local: empty2')
+		self.assertEqual(quick_status(self.dirname), None)
+		self.assertEqual(gitum_repo.status(), STATUS_NEW_COMMITS)
+		self.assertEqual(quick_status(self.dirname), STATUS_NEW_COMMITS)
+		_log('OK')
+
+		_log('checking status of modified patches...')
+		gitum_repo.repo().git.reset('--soft', 'HEAD~2')
+		gitum_repo.repo().git.commit('--amend', '-m', 'local: b2')
+		self.assertEqual(gitum_repo.status(), STATUS_MODIFIED)
+		# the diff is always shown by git
+		self.assertEqual(quick_status(self.dirname), None)
+		_log('OK')
+
+		_log('removing gitum repo...')
+		gitum_repo.remove_all()
+		_log('OK')
+
+		_log('Status test has finished!')
+
 	def test_local_work(self):
 		_log('LocalWork test has started!')
 
@@ -235,6 +383,529 @@ class LocalWorkTest(unittest.TestCase):
 
 		_log('LocalWork test has finished!')
 
+	def _to_text_state(self, filename):
+		with open(filename, 'rb') as f:
+			data = f.read()
+		self.assertEqual(data[:len(STATE_MAGIC)], STATE_MAGIC)
+		fields = STATE_HEADER.unpack(data[:STATE_HEADER.size])
+		pos, num = fields[9:]
+		commits = [data[STATE_HEADER.size + i * 20:STATE_HEADER.size + (i + 1) * 20]
+			   for i in xrange(pos, num)]
+		lines = [binascii.hexlify(i) for i in fields[1:6]] + \
+			[str(i) for i in fields[6:9]] + [binascii.hexlify(i) for i in commits]
+		with open(filename, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+
+	def test_batch_merge(self):
+		_log('BatchMerge test has started!')
+
+		_log('creating git repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a')
+		with open(self.dirname + '/sharedfile', 'w') as f:
+			f.write('a\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.add(self.dirname + '/sharedfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		with open(self.dirname + '/testfile', 'a') as f:
+			f.write('b')
+		with open(self.dirname + '/sharedfile', 'w') as f:
+			f.write('ab\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.add(self.dirname + '/sharedfile')
+		gitum_repo.repo().git.commit('-m', 'local: b')
+		gitum_repo.update()
+		_log('OK')
+
+		_log('making upstream changes...')
+		gitum_repo.repo().git.checkout('merge')
+		for i in xrange(8):
+			if i == 5:
+				with open(self.dirname + '/testfile', 'w') as f:
+					f.write('s')
+				gitum_repo.repo().git.add(self.dirname + '/testfile')
+			else:
+				with open(self.dirname + '/otherfile', 'a') as f:
+					f.write('%d\n' % i)
+				gitum_repo.repo().git.add(self.dirname + '/otherfile')
+			gitum_repo.repo().git.commit('-m', 'remote: %d' % i)
+		_log('OK')
+
+		_log('doing gitum merge in batch mode...')
+		gitum_repo.repo().git.checkout('rebased')
+		self.assertRaises(GitUmException, gitum_repo.merge, batch=0)
+		# the state file of older versions is still understood
+		self._to_text_state(self.dirname + '/.git/.gitum-state')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('sb')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.continue_merge('--continue', batch=0)
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'merge', '--', 'otherfile'), '')
+		# 0-3 as one range, 4 and 5 one by one, 6-7 as one range
+		self.assertEqual(len(gitum_repo.repo().git.rev_list('master..dev').split()), 5)
+		_log('OK')
+
+		_log('making a clean and a conflicting upstream change to our files...')
+		gitum_repo.repo().git.checkout('merge')
+		with open(self.dirname + '/sharedfile', 'w') as f:
+			f.write('a\n\n\n\n\ny\n')
+		gitum_repo.repo().git.add(self.dirname + '/sharedfile')
+		gitum_repo.repo().git.commit('-m', 'remote: 8')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('t')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'remote: 9')
+		_log('OK')
+
+		_log('doing gitum merge in batch mode with replayed rebases...')
+		gitum_repo.repo().git.checkout('rebased')
+		self.assertRaises(GitUmException, gitum_repo.merge, batch=2, replay=True)
+		# stopped in git rebase of the conflicting commit
+		self.assertTrue(os.path.isdir(self.dirname + '/.git/rebase-merge') or
+				os.path.isdir(self.dirname + '/.git/rebase-apply'))
+		self.assertTrue('UU testfile' in
+				gitum_repo.repo().git.status('--porcelain').split('\n'))
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('tb')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.continue_merge('--continue', batch=2, replay=True)
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'merge', '--', 'otherfile'), '')
+		self.assertEqual(gitum_repo.repo().git.show('rebased:testfile'), 'tb')
+		self.assertEqual(gitum_repo.repo().git.show('rebased:sharedfile'), 'ab\n\n\n\n\ny')
+		self.assertEqual(gitum_repo.repo().git.status('--porcelain', '--untracked-files=no'), '')
+		_log('OK')
+
+		_log('removing gitum repo...')
+		gitum_repo.remove_all()
+		_log('OK')
+
+		_log('BatchMerge test has finished!')
+
+	def test_untouched_merge(self):
+		_log('UntouchedMerge test has started!')
+
+		_log('creating git repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		with open(self.dirname + '/testfile', 'a') as f:
+			f.write('b')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: b')
+		gitum_repo.update()
+		_log('OK')
+
+		_log('making upstream changes that do not touch our patches...')
+		gitum_repo.repo().git.checkout('merge')
+		for i in xrange(4):
+			with open(self.dirname + '/otherfile', 'a') as f:
+				f.write('%d\n' % i)
+			gitum_repo.repo().git.add(self.dirname + '/otherfile')
+			gitum_repo.repo().git.commit('-m', 'remote: %d' % i)
+		_log('OK')
+
+		_log('doing gitum merge...')
+		gitum_repo.repo().git.checkout('rebased')
+		profiled = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, profile=True)
+		profiled.merge()
+		report = profiled.profile_report()
+		self.assertEqual(len([i for i in report['stages'] if i['stage'] == 'transplant']), 3)
+		self.assertEqual(len([i for i in report['stages'] if i['stage'] == 'stage2']), 1)
+		self.assertTrue(report['git']['update-ref']['count'] >= 3)
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(gitum_repo.repo().git.merge_base('merge', 'rebased'),
+				 gitum_repo.repo().branches['merge'].commit.hexsha)
+		for i in xrange(4):
+			self.assertEqual(gitum_repo.repo().git.diff('dev~%d' % i, 'merge~%d' % i,
+								 '--', 'otherfile'), '')
+			self.assertEqual(gitum_repo.repo().git.show('dev~%d:testfile' % i), 'ab')
+		with open(self.dirname + '/otherfile', 'r') as f:
+			self.assertEqual(f.read(), '0\n1\n2\n3\n')
+		_log('OK')
+
+		_log('doing gitum update from the current branch...')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('ac')
+		gitum_repo.repo().git.commit('-a', '--amend', '-m', 'local: c')
+		gitum_repo.repo().git.checkout('dev')
+		profiled = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, profile=True)
+		profiled.update('update')
+		report = profiled.profile_report()
+		# the diff piped into git apply is accounted to stage 3
+		self.assertEqual(report['stage_git']['stage3']['diff|apply']['count'], 1)
+		self.assertEqual(report['git']['diff|apply']['count'], 1)
+		self.assertFalse('apply' in report['git'])
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		_log('OK')
+
+		_log('removing gitum repo...')
+		gitum_repo.remove_all()
+		_log('OK')
+
+		_log('UntouchedMerge test has finished!')
+
+	def test_sibling_untouched_merge(self):
+		_log('SiblingUntouchedMerge test has started!')
+
+		_log('creating git repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		os.makedirs(self.dirname + '/dir/sub')
+		for i in ['dir/testfile', 'dir/sub/otherfile']:
+			with open(self.dirname + '/' + i, 'w') as f:
+				f.write('a\n')
+			gitum_repo.repo().git.add(self.dirname + '/' + i)
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		with open(self.dirname + '/dir/testfile', 'a') as f:
+			f.write('b\n')
+		gitum_repo.repo().git.add(self.dirname + '/dir/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: b')
+		gitum_repo.update()
+		_log('OK')
+
+		_log('making upstream changes next to our patches...')
+		gitum_repo.repo().git.checkout('merge')
+		for i in ['dir/sub/otherfile', 'dir/newfile', 'dir/sub/otherfile']:
+			with open(self.dirname + '/' + i, 'a') as f:
+				f.write('c\n')
+			gitum_repo.repo().git.add(self.dirname + '/' + i)
+			gitum_repo.repo().git.commit('-m', 'remote: %s' % i)
+		_log('OK')
+
+		_log('doing gitum merge...')
+		gitum_repo.repo().git.checkout('rebased')
+		profiled = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, profile=True)
+		profiled.merge()
+		report = profiled.profile_report()
+		# the files in the directory of our patch do not touch it
+		self.assertEqual(len([i for i in report['stages'] if i['stage'] == 'transplant']), 2)
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'merge', '--', 'dir/sub', 'dir/newfile'), '')
+		self.assertEqual(gitum_repo.repo().git.show('dev~:dir/testfile'), 'a\nb')
+		_log('OK')
+
+		_log('removing gitum repo...')
+		gitum_repo.remove_all()
+		_log('OK')
+
+		_log('SiblingUntouchedMerge test has finished!')
+
+	def test_replay_merge(self):
+		_log('ReplayMerge test has started!')
+
+		_log('creating git repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		for data in ['ab\n\n\n\n\nz\n', 'abc\n\n\n\n\nz\n']:
+			with open(self.dirname + '/testfile', 'w') as f:
+				f.write(data)
+			gitum_repo.repo().git.add(self.dirname + '/testfile')
+			gitum_repo.repo().git.commit('-m', 'local: ' + data[:3])
+		gitum_repo.update()
+		dates = gitum_repo.repo().git.log('--format=%ad', 'master..rebased')
+		_log('OK')
+
+		_log('making upstream changes...')
+		gitum_repo.repo().git.checkout('merge')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a\n\n\n\n\ny\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'remote: y')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('s\n\n\n\n\ny\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'remote: s')
+		_log('OK')
+
+		_log('doing gitum merge with replayed rebases...')
+		self.assertRaises(GitUmException, gitum_repo.merge, replay=True)
+		self.assertEqual(gitum_repo.repo().git.show('rebased:testfile'), 'abc\n\n\n\n\ny')
+		self.assertEqual(gitum_repo.repo().git.log('--format=%ad', 'merge~..rebased'), dates)
+		for data in ['sb\n\n\n\n\ny\n', 'sbc\n\n\n\n\ny\n']:
+			with open(self.dirname + '/testfile', 'w') as f:
+				f.write(data)
+			gitum_repo.repo().git.add(self.dirname + '/testfile')
+			try:
+				gitum_repo.continue_merge('--continue', replay=True)
+			except GitUmException:
+				pass
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(gitum_repo.repo().git.show('dev:testfile'), 'sbc\n\n\n\n\ny')
+		_log('OK')
+
+		_log('removing gitum repo...')
+		gitum_repo.remove_all()
+		_log('OK')
+
+		_log('ReplayMerge test has finished!')
+
+	def test_worktree_merge(self):
+		_log('WorktreeMerge test has started!')
+
+		_log('creating git repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('ab\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: b')
+		gitum_repo.update()
+		gitum_repo.repo().git.checkout('merge')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a\n\n\n\n\ny\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'remote: y')
+		gitum_repo.repo().git.checkout('rebased')
+		_log('OK')
+
+		_log('doing gitum merge in a private work tree...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, worktree=True)
+		gitum_repo.merge()
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertNotEqual(gitum_repo.repo().working_tree_dir, self.dirname)
+		main_repo = git.Repo(self.dirname)
+		self.assertEqual(main_repo.active_branch.name, 'rebased')
+		self.assertFalse(main_repo.is_dirty())
+		with open(self.dirname + '/testfile', 'r') as f:
+			self.assertEqual(f.read(), 'ab\n\n\n\n\ny\n')
+		_log('OK')
+
+		_log('restoring in a private work tree...')
+		gitum_repo.restore(commit='patches^')
+		self.assertFalse(main_repo.is_dirty())
+		with open(self.dirname + '/testfile', 'r') as f:
+			self.assertEqual(f.read(), 'ab\n\n\n\n\nz\n')
+		_log('OK')
+
+		_log('checking a too old git...')
+		module = sys.modules[GitUpstream.__module__]
+		version = module.WORKTREE_GIT_VERSION
+		module.WORKTREE_GIT_VERSION = (99, 0)
+		try:
+			self.assertRaises(NotSupported, GitUpstream, repo_path=self.dirname,
+					  with_log=_WITH_LOG, worktree=True)
+		finally:
+			module.WORKTREE_GIT_VERSION = version
+		_log('OK')
+
+		_log('removing gitum repo...')
+		gitum_repo.remove_all()
+		_log('OK')
+
+		_log('WorktreeMerge test has finished!')
+
+	def test_batch_driver(self):
+		_log('BatchDriver test has started!')
+
+		_log('creating gitum repos...')
+		for name, data in [('clean', 'a\n\n\n\n\ny\n'), ('conflict', 's\n\n\n\n\nz\n'),
+				   ('behind', 'a\n\n\n\n\ny\n')]:
+			dirname = self.dirname + '/' + name
+			gitum_repo = GitUpstream(repo_path=dirname, with_log=_WITH_LOG, new_repo=True)
+			gitum_repo.repo().git.config('user.name', '"tester"')
+			gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+			with open(dirname + '/testfile', 'w') as f:
+				f.write('a\n\n\n\n\nz\n')
+			gitum_repo.repo().git.add(dirname + '/testfile')
+			gitum_repo.repo().git.commit('-m', 'initial')
+			gitum_repo.repo().create_head('merge')
+			gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+			gitum_repo.repo().git.checkout('rebased')
+			with open(dirname + '/testfile', 'w') as f:
+				f.write('ab\n\n\n\n\nz\n')
+			gitum_repo.repo().git.add(dirname + '/testfile')
+			gitum_repo.repo().git.commit('-m', 'local: b')
+			gitum_repo.update()
+			gitum_repo.repo().git.checkout('merge')
+			with open(dirname + '/testfile', 'w') as f:
+				f.write(data)
+			gitum_repo.repo().git.add(dirname + '/testfile')
+			gitum_repo.repo().git.commit('-m', 'remote change')
+			gitum_repo.repo().git.checkout('rebased')
+		with open(self.dirname + '/manifest', 'w') as f:
+			f.write('# nightly\n')
+			f.write('%s/clean merge\n' % self.dirname)
+			f.write('%s/conflict merge merge\n' % self.dirname)
+			f.write('%s/missing status\n' % self.dirname)
+			f.write('%s/behind status merge\n' % self.dirname)
+			# operations on one repo run in order, after a conflict the
+			# rest of them are skipped
+			f.write('%s/clean status merge\n' % self.dirname)
+			f.write('%s/conflict status\n' % self.dirname)
+		_log('OK')
+
+		_log('running gitum batch...')
+		jobs = load_manifest(self.dirname + '/manifest')
+		self.assertEqual(len(jobs), 6)
+		res = run_batch(jobs, 2)
+		self.assertEqual([i[2] for i in res], [CLEAN, CONFLICTED, FAILED, STATUS_UPSTREAM_COMMITS,
+						       STATUS_CLEAN, SKIPPED])
+		self.assertEqual(res[3][3], 'commits to merge from merge: 1')
+		self.assertEqual(res[5][:2], (self.dirname + '/conflict', 'status'))
+		self.assertEqual(res[5][3], 'after merge conflicted')
+		self.assertTrue(os.path.exists(self.dirname + '/conflict/.git/.gitum-state'))
+		_log('OK')
+
+		_log('BatchDriver test has finished!')
+
+	def _wait_for(self, func):
+		for i in xrange(100):
+			res = func()
+			if res:
+				return res
+			time.sleep(0.05)
+		self.fail('timed out')
+
+	def test_daemon(self):
+		_log('Daemon test has started!')
+
+		_log('creating gitum repo...')
+		gitum_repo = GitUpstream(repo_path=self.dirname, with_log=_WITH_LOG, new_repo=True)
+		gitum_repo.repo().git.config('user.name', '"tester"')
+		gitum_repo.repo().git.config('user.email', '"tester@localhost"')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'initial')
+		gitum_repo.repo().create_head('merge')
+		gitum_repo.create('merge', 'master' , 'rebased', 'dev', 'patches')
+		gitum_repo.repo().git.checkout('rebased')
+		_log('OK')
+
+		_log('starting gitum daemon...')
+		daemon = Daemon(self.dirname, poll=0.05)
+		thread = threading.Thread(target=daemon.serve)
+		thread.start()
+		try:
+			self._daemon_work(gitum_repo, daemon, thread)
+		finally:
+			daemon.stop()
+			thread.join()
+		self.assertFalse(os.path.exists(self.dirname + '/.git/.gitum-daemon.sock'))
+		self.assertEqual(daemon_request(self.dirname, 'status'), None)
+		_log('OK')
+
+		_log('Daemon test has finished!')
+
+	def _daemon_work(self, gitum_repo, daemon, thread):
+		reply = self._wait_for(lambda: daemon_request(self.dirname, 'status'))
+		self.assertEqual(reply['status'], STATUS_CLEAN)
+		self.assertEqual(reply['messages'], ['Nothing to update.'])
+		_log('OK')
+
+		_log('checking a stalled client...')
+		stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		stalled.connect(self.dirname + '/.git/.gitum-daemon.sock')
+		try:
+			start = time.time()
+			self.assertEqual(daemon_status(self.dirname), STATUS_CLEAN)
+			self.assertTrue(time.time() - start < DAEMON_CONN_TIMEOUT)
+			stalled.settimeout(5.0)
+			self.assertEqual(stalled.recv(1), '')
+		finally:
+			stalled.close()
+		_log('OK')
+
+		_log('checking status while another one is computed...')
+		daemon._lock.acquire()
+		threading.Timer(0.1, daemon._lock.release).start()
+		self.assertEqual(daemon_request(self.dirname, 'status')['status'], STATUS_CLEAN)
+		_log('OK')
+
+		_log('checking status of a broken repo...')
+		name = self.dirname + '/.git/.curent_rebased'
+		os.rename(name, name + '.bak')
+		try:
+			# the daemon refreshes its answer meanwhile
+			time.sleep(0.2)
+			self.assertTrue('error' in daemon_request(self.dirname, 'status'))
+			self.assertEqual(daemon_status(self.dirname), None)
+			self.assertTrue(thread.is_alive())
+		finally:
+			os.rename(name + '.bak', name)
+		self.assertEqual(daemon_status(self.dirname), STATUS_CLEAN)
+		_log('OK')
+
+		_log('checking status of new commits...')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('ab\n\n\n\n\nz\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'local: b')
+		gitum_repo.update()
+		gitum_repo.repo().git.commit('--allow-empty', '-m', 'local: empty')
+		self.assertEqual(daemon_status(self.dirname), STATUS_NEW_COMMITS)
+		self.assertEqual(daemon_request(self.dirname, 'status')['messages'][1:], ['\tlocal: empty'])
+		gitum_repo.repo().git.reset('--hard', 'HEAD~')
+		self.assertEqual(daemon_status(self.dirname), STATUS_CLEAN)
+		_log('OK')
+
+		_log('checking merge preview...')
+		gitum_repo.repo().git.checkout('merge')
+		with open(self.dirname + '/otherfile', 'w') as f:
+			f.write('c\n')
+		gitum_repo.repo().git.add(self.dirname + '/otherfile')
+		gitum_repo.repo().git.commit('-m', 'remote: c')
+		with open(self.dirname + '/testfile', 'w') as f:
+			f.write('a\n\n\n\n\ny\n')
+		gitum_repo.repo().git.add(self.dirname + '/testfile')
+		gitum_repo.repo().git.commit('-m', 'remote: y')
+		gitum_repo.repo().git.checkout('rebased')
+		reply = daemon_request(self.dirname, 'preview', 'merge')
+		self.assertEqual(reply['branch'], 'merge')
+		self.assertEqual([(i['summary'], i['conflicts']) for i in reply['commits']],
+				 [('remote: c', []), ('remote: y', ['testfile'])])
+		_log('OK')
+
+		_log('running a merge job...')
+		reply = daemon_request(self.dirname, 'merge', 'merge')
+		self.assertEqual(reply['job'], 1)
+		job = self._wait_for(lambda: [i for i in daemon_request(self.dirname, 'jobs')['jobs']
+					      if i['state'] not in ['queued', 'running']])[0]
+		self.assertEqual(job['state'], CLEAN)
+		self.assertEqual(gitum_repo.repo().git.diff('dev', 'rebased'), '')
+		self.assertEqual(gitum_repo.repo().git.diff('merge', 'master'), '')
+		self.assertEqual(daemon_status(self.dirname), STATUS_CLEAN)
+		self.assertEqual(daemon_request(self.dirname, 'preview', 'merge')['commits'], [])
+		_log('OK')
+
+		_log('stopping gitum daemon...')
+		self.assertEqual(daemon_request(self.dirname, 'stop'), {'stopped': True})
+
 class RemoteWorkTest(unittest.TestCase):
 	def setUp(self):
 		self.dirname1 = tempfile.mkdtemp()
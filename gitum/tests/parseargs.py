@@ -18,6 +18,13 @@ def main():
 	parser = argparse.ArgumentParser(description='Git Upstream Manager')
 	parser.add_argument('--repo', 
 		help='path to the gitum repo (does not take affect in clone command)')
+	parser.add_argument('--worktree', action='store_true',
+		help='run merge, pull, update and restore in a private work tree, '
+		     'updating only the branches of the main one')
+	parser.add_argument('--profile', action='store_true',
+		help='print a JSON report of stage timings and git commands to stderr')
+	parser.add_argument('--profile-output', metavar='file',
+		help='write the profile report to a file instead of stderr')
 	#parser.add_argument('--remote',
 	#	help='path to the gitum repo (does not take affect in clone command)')
 	subparsers = parser.add_subparsers(dest='command_name')
@@ -30,6 +37,11 @@ def main():
 	merge_p = subparsers.add_parser('merge')
 	gr_merge = merge_p.add_mutually_exclusive_group()
 	merge_p.add_argument('--track', action='store_true', help='save the branch to use by default')
+	merge_p.add_argument('--batch', nargs='?', const=0, type=int, metavar='N',
+		help='merge upstream commits in ranges of up to N commits (unlimited by default) '
+		     'while our patches rebase cleanly')
+	merge_p.add_argument('--replay', action='store_true',
+		help='rebase our patches with tree-level merges, without checking them out')
 	gr_merge.add_argument('--continue', action='store_true', help='continue a merge process')
 	gr_merge.add_argument('--skip', action='store_true',
 		help='skip the current patch in rebase and continue a merge process')
@@ -62,7 +74,10 @@ def main():
 
 	restore_p = subparsers.add_parser('restore')
 	restore_p.add_argument('--commit', metavar='commit/branch',
-			help='restore rebased branch to a given commit')
+			help='restore rebased branch to a given patches commit or to the state '
+			     'saved for a given upstream/mainline commit')
+	restore_p.add_argument('--date', metavar='date',
+			help='restore to the state saved at a given date (e.g. "2 days ago")')
 	restore_p.add_argument('--full', action='store_true',
 				help='restore full repository branches')
 
@@ -85,6 +100,19 @@ def main():
 
 	status_p = subparsers.add_parser('status')
 
+	daemon_p = subparsers.add_parser('daemon')
+	daemon_p.add_argument('request', nargs='*',
+			help='send a request to the running daemon instead of starting one: '
+			     'status, preview [branch], merge [branch], pull [remote], jobs or stop')
+	daemon_p.add_argument('--poll', type=float, default=1.0, metavar='seconds',
+			help='interval of checking the branches for changes (1 second by default)')
+
+	batch_p = subparsers.add_parser('batch')
+	batch_p.add_argument('manifest',
+			help='file with "<repo> <merge|pull|status|push> [remote/branch]" lines')
+	batch_p.add_argument('--jobs', '-j', type=int, metavar='N',
+			help='number of repos processed at once (CPU count by default)')
+
 	args = vars(parser.parse_args(sys.argv[1:]))
 	print(args)
 